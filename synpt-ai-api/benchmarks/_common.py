@@ -0,0 +1,26 @@
+"""Helpers shared by the benchmark scripts."""
+from datetime import datetime
+
+FILLER_SENTENCE = "This earlier message discusses implementation details, trade-offs and follow-up questions. "
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def seeded_history(count: int, filler_sentences: int = 6):
+    """``count`` alternating user/ai messages of a few hundred characters each"""
+    now = datetime.now().isoformat()
+    filler = FILLER_SENTENCE * filler_sentences
+    return [
+        {
+            "type": "user" if i % 2 == 0 else "ai",
+            "content": f"Message {i} about topic {i % 9}. {filler}",
+            "timestamp": now,
+        }
+        for i in range(count)
+    ]
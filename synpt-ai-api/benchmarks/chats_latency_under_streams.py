@@ -0,0 +1,109 @@
+"""Measure GET /chats latency while N /stream-generate streams are running.
+
+Run against a live backend (uvicorn main:app) with Ollama available:
+
+    python benchmarks/chats_latency_under_streams.py --model llama3.2 --streams 0,4,16
+
+For every stream count the script opens that many concurrent generations,
+hammers GET /chats in parallel and prints p50/p95/p99 latencies. With a
+blocking Ollama client the p99 grows with the number of streams; with the
+async client it should stay close to the idle baseline.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime
+
+import httpx
+
+from _common import percentile
+
+
+async def create_chat(client: httpx.AsyncClient, model: str) -> str:
+    now = datetime.now().isoformat()
+    response = await client.post("/chats", json={
+        "title": "benchmark",
+        "messages": [],
+        "created_at": now,
+        "updated_at": now,
+        "model": {"name": model, "size": 0}
+    })
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+async def run_stream(client: httpx.AsyncClient, chat_id: str, prompt: str, stop: asyncio.Event):
+    while not stop.is_set():
+        params = {"prompt": prompt, "chat_id": chat_id}
+        async with client.stream("GET", "/stream-generate", params=params) as response:
+            async for _ in response.aiter_lines():
+                if stop.is_set():
+                    return
+
+
+async def measure_chats(client: httpx.AsyncClient, requests: int, concurrency: int):
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.get("/chats")
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def run(args):
+    timeout = httpx.Timeout(None)
+    limits = httpx.Limits(max_connections=None)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=timeout, limits=limits) as client:
+        chat_ids = [await create_chat(client, args.model) for _ in range(max(args.streams))]
+        try:
+            for streams in args.streams:
+                stop = asyncio.Event()
+                tasks = [
+                    asyncio.create_task(run_stream(client, chat_id, args.prompt, stop))
+                    for chat_id in chat_ids[:streams]
+                ]
+                await asyncio.sleep(args.warmup)
+                latencies = await measure_chats(client, args.requests, args.concurrency)
+                stop.set()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+                print(
+                    f"streams={streams:<4} requests={len(latencies):<5} "
+                    f"mean={statistics.mean(latencies):8.1f}ms "
+                    f"p50={percentile(latencies, 50):8.1f}ms "
+                    f"p95={percentile(latencies, 95):8.1f}ms "
+                    f"p99={percentile(latencies, 99):8.1f}ms"
+                )
+        finally:
+            for chat_id in chat_ids:
+                await client.delete(f"/chats/{chat_id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--model", required=True, help="Installed Ollama model used by the streams")
+    parser.add_argument("--streams", default="0,4,16", help="Comma separated stream counts to test")
+    parser.add_argument("--requests", type=int, default=200, help="GET /chats requests per stream count")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel GET /chats callers")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds to let streams start before measuring")
+    parser.add_argument("--prompt", default="Write a long essay about the history of computing.")
+    args = parser.parse_args()
+    args.streams = [int(value) for value in args.streams.split(",")]
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Fake Ollama server for offline benchmarks.
+
+Serves the parts of the Ollama API the backend uses (``/api/chat`` streaming,
+``/api/generate`` for preloading and ``/api/tags``) and streams a canned
+Markdown answer at a fixed rate, so the backend can be load tested without a
+GPU or a model:
+
+    python benchmarks/fake_ollama.py --port 11500 --token-rate 50 --chunk-tokens 1
+
+``--token-rate`` is tokens per second per generation, ``--chunk-tokens`` the
+tokens per streamed chunk (Ollama sends one), ``--response-tokens`` the answer
+length and ``--first-token-delay`` the simulated prompt evaluation time.
+``GET /_stats`` returns how many generations, chunks and tokens were sent.
+offline_load.py starts this server itself.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import time
+from datetime import datetime, timezone
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+ANSWER_TEMPLATE = """## Overview
+This answer explains the approach in a few steps with **important details** highlighted along the way.
+
+1. Read the input and validate it
+2. Transform the data into the target shape
+3. Store the result and report progress
+
+```python
+def transform(records):
+    result = []
+    for record in records:
+        if record.get("active"):
+            result.append({"id": record["id"], "score": record["score"] * 2})
+    return result
+```
+
+| Step | Cost | Notes |
+|---|---|---|
+| Read | low | streaming input |
+| Transform | medium | *CPU bound* |
+| Store | high | one bulk write |
+
+- The transform is pure, so it is easy to test
+- Bulk writes keep the database load low
+
+"""
+TOKEN_PATTERN = re.compile(r'\S+\s*|\s+')
+TEMPLATE_TOKENS = TOKEN_PATTERN.findall(ANSWER_TEMPLATE)
+
+
+def answer_tokens(count: int):
+    """The first ``count`` tokens of the template, repeated as needed"""
+    return [TEMPLATE_TOKENS[i % len(TEMPLATE_TOKENS)] for i in range(count)]
+
+
+def timestamp() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def create_app(args) -> FastAPI:
+    app = FastAPI()
+    stats = {"generations": 0, "active": 0, "chunks": 0, "tokens": 0, "preloads": 0}
+    tokens = answer_tokens(args.response_tokens)
+    interval = args.chunk_tokens / args.token_rate
+    models = [name if ":" in name else f"{name}:latest" for name in args.models.split(",")]
+
+    async def chat_stream(model: str):
+        stats["generations"] += 1
+        stats["active"] += 1
+        try:
+            await asyncio.sleep(args.first_token_delay)
+            started = time.monotonic()
+            for chunk_index, start in enumerate(range(0, len(tokens), args.chunk_tokens)):
+                # Pace against the start time so slow event loop turns do not add up
+                delay = started + chunk_index * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                piece = tokens[start:start + args.chunk_tokens]
+                stats["chunks"] += 1
+                stats["tokens"] += len(piece)
+                yield json.dumps({
+                    "model": model,
+                    "created_at": timestamp(),
+                    "message": {"role": "assistant", "content": "".join(piece)},
+                    "done": False
+                }) + "\n"
+            yield json.dumps({
+                "model": model,
+                "created_at": timestamp(),
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                "done_reason": "stop",
+                "eval_count": len(tokens),
+                "eval_duration": int((time.monotonic() - started) * 1e9)
+            }) + "\n"
+        finally:
+            stats["active"] -= 1
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        model = body.get("model", models[0])
+        if body.get("stream", True):
+            return StreamingResponse(chat_stream(model), media_type="application/x-ndjson")
+        return JSONResponse({
+            "model": model,
+            "created_at": timestamp(),
+            "message": {"role": "assistant", "content": "".join(tokens)},
+            "done": True
+        })
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        stats["preloads"] += 1
+        return JSONResponse({"model": body.get("model", models[0]), "created_at": timestamp(), "response": "", "done": True})
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [
+            {
+                "name": name,
+                "model": name,
+                "modified_at": timestamp(),
+                "size": 1024 ** 3,
+                "digest": hashlib.sha256(name.encode()).hexdigest(),
+                "details": {"format": "gguf", "family": "fake", "parameter_size": "1B", "quantization_level": "Q4_0"}
+            }
+            for name in models
+        ]}
+
+    @app.get("/_stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Tokens per second per generation")
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="Tokens per streamed chunk")
+    parser.add_argument("--response-tokens", type=int, default=300, help="Tokens per answer")
+    parser.add_argument("--first-token-delay", type=float, default=0.05, help="Seconds before the first chunk")
+    parser.add_argument("--models", default="bench", help="Comma separated model names to report as installed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
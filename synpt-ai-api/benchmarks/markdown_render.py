@@ -0,0 +1,81 @@
+"""Compare the single-pass Markdown renderer with the original regex cascade.
+
+Runs offline, no Ollama or MongoDB needed. From the synpt-ai-api directory:
+
+    python benchmarks/markdown_render.py --sizes 10,100,1000
+
+For every size a synthetic response is generated with that many blocks of
+headers, paragraphs with bold text, numbered and bullet lists, then rendered
+with ``_format_text_content`` and ``_format_text_content_regex``. The script
+checks that both produce the same HTML and prints the time per render and the
+speedup. A table-heavy response is timed as well through
+``parse_content_to_sections``.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import content_parser  # noqa: E402
+
+
+def synthetic_text(blocks: int) -> str:
+    parts = []
+    for i in range(blocks):
+        parts.append(f"## Section {i}")
+        parts.append(f"This is paragraph {i} with **bold words** and some plain text that goes on for a while.")
+        parts.append("")
+        for item in range(1, 6):
+            parts.append(f"{item}. Step {item} with **emphasis** on the detail")
+        parts.append("")
+        for item in range(4):
+            parts.append(f"- Bullet {item} explaining a point")
+        parts.append("")
+    return "\n".join(parts).strip()
+
+
+def synthetic_tables(blocks: int) -> str:
+    parts = []
+    for i in range(blocks):
+        parts.append(f"Table {i} compares the options:")
+        parts.append("| Option | **Speed** | *Notes* |")
+        parts.append("|---|---|---|")
+        for row in range(10):
+            parts.append(f"| option {row} | **{row * 10} ms** | *fine* |")
+        parts.append("")
+    return "\n".join(parts)
+
+
+def best_time(func, text: str, repeat: int) -> float:
+    number = max(1, 200_000 // max(len(text), 1))
+    return min(timeit.repeat(lambda: func(text), number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000", help="Comma separated block counts")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for blocks in [int(value) for value in args.sizes.split(",")]:
+        text = synthetic_text(blocks)
+        if content_parser._format_text_content(text) != content_parser._format_text_content_regex(text):
+            raise SystemExit(f"Renderers disagree for {blocks} blocks")
+
+        single_pass = best_time(content_parser._format_text_content, text, args.repeat)
+        cascade = best_time(content_parser._format_text_content_regex, text, args.repeat)
+        print(
+            f"text   blocks={blocks:<5} chars={len(text):<8} "
+            f"regex={cascade * 1000:9.3f}ms single_pass={single_pass * 1000:9.3f}ms "
+            f"speedup={cascade / single_pass:5.1f}x"
+        )
+
+        tables = synthetic_tables(blocks)
+        parse_time = best_time(content_parser.parse_content_to_sections, tables, args.repeat)
+        print(f"tables blocks={blocks:<5} chars={len(tables):<8} parse={parse_time * 1000:9.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Run the backend against local stand-ins for Ollama and MongoDB.
+
+    python benchmarks/offline_backend.py --port 8100 --ollama-host http://127.0.0.1:11500
+    python benchmarks/offline_backend.py --port 8100 --ollama-host http://127.0.0.1:11500 \\
+        --mongo-url mongodb://localhost:27017
+
+Ollama is whatever ``--ollama-host`` points at, normally fake_ollama.py.
+Without ``--mongo-url`` the chats live in an in-process mongomock database
+(``pip install -r benchmarks/requirements.txt``); with it, in a local MongoDB, in the
+``--mongo-db`` database. The app also gets ``GET /_bench/process`` with the
+CPU time and peak RSS of the server process, which offline_load.py uses to
+compute CPU per token. offline_load.py starts this server itself.
+"""
+import argparse
+import inspect
+import os
+import sys
+import time
+
+import uvicorn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def patch_mongomock_bulk_updates():
+    """Newer pymongo versions pass ``sort`` to bulk updates, which mongomock does not accept"""
+    import mongomock.collection
+
+    builder = mongomock.collection.BulkOperationBuilder
+    original = builder.add_update
+    if "sort" in inspect.signature(original).parameters:
+        return
+
+    def add_update(self, *args, sort=None, **kwargs):
+        return original(self, *args, **kwargs)
+
+    builder.add_update = add_update
+
+
+def stand_in_database(mongo_url, mongo_db):
+    if mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(mongo_url)[mongo_db]
+
+    from mongomock_motor import AsyncMongoMockClient
+    patch_mongomock_bulk_updates()
+    return AsyncMongoMockClient()[mongo_db]
+
+
+def use_database(main, database):
+    """Point every module-level collection reference of the app at ``database``"""
+    main.db = database
+    main.chats_collection = database.chats
+    main.memories_collection = database.chat_memories
+    main.DATABASE_INDEXES = [
+        (database[collection.name], keys, options)
+        for collection, keys, options in main.DATABASE_INDEXES
+    ]
+    main.OBSOLETE_INDEXES = [(database[collection.name], name) for collection, name in main.OBSOLETE_INDEXES]
+
+
+async def skip_query_plans() -> dict:
+    """mongomock cursors have no ``explain()``, so there are no plans to verify"""
+    return {}
+
+
+def process_stats() -> dict:
+    stats = {"cpu_seconds": time.process_time(), "max_rss_kb": None}
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats["max_rss_kb"] = max_rss // 1024 if sys.platform == "darwin" else max_rss
+    except ImportError:  # Windows
+        pass
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ollama-host", default="http://127.0.0.1:11500")
+    parser.add_argument("--mongo-url", help="Local MongoDB to use instead of the in-process mongomock database")
+    parser.add_argument("--mongo-db", default="synaptic_benchmark")
+    args = parser.parse_args()
+
+    # Read by main at import time
+    os.environ["OLLAMA_HOST"] = args.ollama_host
+    import main as backend
+
+    use_database(backend, stand_in_database(args.mongo_url, args.mongo_db))
+    if not args.mongo_url:
+        backend.verify_query_plans = skip_query_plans
+    backend.app.get("/_bench/process")(process_stats)
+
+    uvicorn.run(backend.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""Offline load test of the backend against fake Ollama and MongoDB stand-ins.
+
+No Ollama, GPU or remote MongoDB needed. From the synpt-ai-api directory:
+
+    python benchmarks/offline_load.py --streams 8 --turns 3 --output baseline.json
+    # change the code, then
+    python benchmarks/offline_load.py --streams 8 --turns 3 --output after.json --compare baseline.json
+
+The script starts fake_ollama.py and offline_backend.py on free local ports
+(backend settings such as MAX_CONCURRENT_GENERATIONS are read from the
+environment as usual) and seeds ``--streams`` chats with ``--history``
+messages. Then three workloads run at once until the streams are done:
+
+- stream: every chat plays ``--turns`` turns through /stream-generate
+- chats: ``--readers`` clients alternate GET /chats and GET /chats/{id}
+- memory: ``--memory-clients`` clients alternate POST /chats/{id}/update-memory
+  and GET /chats/{id}/memory-stats
+
+Per workload it reports latency percentiles, throughput and bytes received,
+plus the backend's CPU time per streamed token, and writes everything as JSON.
+``--compare`` prints the change of the headline numbers against an earlier file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+from _common import percentile, seeded_history
+from fake_ollama import add_arguments as add_fake_ollama_arguments
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (path in the result, lower is better)
+HEADLINE_METRICS = [
+    ("stream.ttft_ms.p50", True),
+    ("stream.ttft_ms.p95", True),
+    ("stream.duration_ms.p95", True),
+    ("stream.tokens_per_second", False),
+    ("stream.bytes_per_token", True),
+    ("chats.latency_ms.p50", True),
+    ("chats.latency_ms.p95", True),
+    ("chats.latency_ms.p99", True),
+    ("memory.latency_ms.p95", True),
+    ("backend.cpu_ms_per_token", True),
+    ("backend.max_rss_kb", True),
+]
+
+
+def distribution(values) -> dict:
+    return {
+        "mean": statistics.mean(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Workload:
+    """Latencies, errors and bytes of one workload"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    def summary(self, wall_seconds: float) -> dict:
+        return {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "latency_ms": distribution(self.latencies),
+            "throughput_rps": len(self.latencies) / wall_seconds if wall_seconds else 0.0,
+            "bytes_received": self.bytes,
+        }
+
+
+class StreamWorkload(Workload):
+    def __init__(self):
+        super().__init__()
+        self.ttfts = []
+        self.chunks = 0
+
+
+async def start_process(script: str, args: list, log):
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCHMARK_DIR, script), *args,
+        stdout=log, stderr=log
+    )
+
+
+async def wait_until_ready(url: str, process, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.returncode is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode} before it was ready")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} was not ready within {timeout}s")
+
+
+async def stop_process(process):
+    if process.returncode is None:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), 10)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+async def create_chats(client: httpx.AsyncClient, count: int, history: int, model: str):
+    chat_ids = []
+    for i in range(count):
+        now = datetime.now().isoformat()
+        response = await client.post("/chats", json={
+            "title": f"offline benchmark {i}",
+            "messages": seeded_history(history, filler_sentences=4),
+            "created_at": now,
+            "updated_at": now,
+            "model": {"name": model, "size": 0}
+        })
+        response.raise_for_status()
+        chat_ids.append(response.json()["id"])
+
+    # Let the background memory indexing of the seeded history finish first
+    while (await client.get("/health")).json().get("memory_index_queue", 0):
+        await asyncio.sleep(0.1)
+    return chat_ids
+
+
+async def stream_turn(client: httpx.AsyncClient, chat_id: str, prompt: str, protocol: int, workload: StreamWorkload):
+    started = time.perf_counter()
+    first_chunk = None
+    completed = False
+    try:
+        params = {"prompt": prompt, "chat_id": chat_id, "protocol": protocol}
+        async with client.stream("GET", "/stream-generate", params=params) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                status = json.loads(line[len("data:"):]).get("status")
+                if status == "streaming":
+                    workload.chunks += 1
+                    first_chunk = first_chunk or time.perf_counter()
+                elif status == "complete":
+                    completed = True
+                elif status == "error":
+                    break
+            workload.bytes += response.num_bytes_downloaded
+    except httpx.HTTPError:
+        pass
+    if not completed or first_chunk is None:
+        workload.errors += 1
+        return
+    workload.ttfts.append((first_chunk - started) * 1000)
+    workload.latencies.append((time.perf_counter() - started) * 1000)
+
+
+async def play_chat(client: httpx.AsyncClient, chat_id: str, turns: int, protocol: int, workload: StreamWorkload):
+    for turn in range(turns):
+        prompt = f"Briefly, what did we say about topic {turn % 9}? (turn {turn + 1})"
+        await stream_turn(client, chat_id, prompt, protocol, workload)
+
+
+async def timed_request(client: httpx.AsyncClient, method: str, url: str, workload: Workload):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url)
+        response.raise_for_status()
+    except httpx.HTTPError:
+        workload.errors += 1
+        return
+    workload.latencies.append((time.perf_counter() - started) * 1000)
+    workload.bytes += len(response.content)
+
+
+async def read_chats(client: httpx.AsyncClient, chat_ids: list, done: asyncio.Event, workload: Workload):
+    while not done.is_set():
+        await timed_request(client, "GET", "/chats?limit=20", workload)
+        await timed_request(client, "GET", f"/chats/{random.choice(chat_ids)}", workload)
+
+
+async def use_memory(client: httpx.AsyncClient, chat_ids: list, done: asyncio.Event, workload: Workload):
+    while not done.is_set():
+        chat_id = random.choice(chat_ids)
+        await timed_request(client, "POST", f"/chats/{chat_id}/update-memory", workload)
+        await timed_request(client, "GET", f"/chats/{chat_id}/memory-stats", workload)
+
+
+async def run_workloads(args, backend_url: str, ollama_url: str) -> dict:
+    limits = httpx.Limits(max_connections=args.streams + args.readers + args.memory_clients + 4)
+    async with httpx.AsyncClient(base_url=backend_url, timeout=httpx.Timeout(None), limits=limits) as client, \
+            httpx.AsyncClient(base_url=ollama_url) as ollama:
+        model = args.models.split(",")[0]
+        chat_ids = await create_chats(client, args.streams, args.history, model)
+
+        streams, chats, memory = StreamWorkload(), Workload(), Workload()
+        done = asyncio.Event()
+        cpu_before = (await client.get("/_bench/process")).json()["cpu_seconds"]
+        tokens_before = (await ollama.get("/_stats")).json()["tokens"]
+        started = time.perf_counter()
+
+        background = [asyncio.create_task(read_chats(client, chat_ids, done, chats)) for _ in range(args.readers)]
+        background += [asyncio.create_task(use_memory(client, chat_ids, done, memory)) for _ in range(args.memory_clients)]
+        try:
+            await asyncio.gather(*(play_chat(client, chat_id, args.turns, args.protocol, streams) for chat_id in chat_ids))
+        finally:
+            done.set()
+            await asyncio.gather(*background)
+
+        wall = time.perf_counter() - started
+        process = (await client.get("/_bench/process")).json()
+        tokens = (await ollama.get("/_stats")).json()["tokens"] - tokens_before
+        cpu = process["cpu_seconds"] - cpu_before
+
+        if not args.keep_chats:
+            for chat_id in chat_ids:
+                await client.delete(f"/chats/{chat_id}")
+
+    stream_summary = streams.summary(wall)
+    stream_summary["duration_ms"] = stream_summary.pop("latency_ms")
+    stream_summary.update({
+        "ttft_ms": distribution(streams.ttfts),
+        "chunks": streams.chunks,
+        "tokens": tokens,
+        "tokens_per_second": tokens / wall if wall else 0.0,
+        "bytes_per_token": streams.bytes / tokens if tokens else 0.0,
+    })
+    return {
+        "wall_seconds": wall,
+        "stream": stream_summary,
+        "chats": chats.summary(wall),
+        "memory": memory.summary(wall),
+        "backend": {
+            "cpu_seconds": cpu,
+            "cpu_ms_per_token": cpu * 1000 / tokens if tokens else 0.0,
+            "max_rss_kb": process["max_rss_kb"],
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    ollama_port, backend_port = free_port(), free_port()
+    ollama_url = f"http://127.0.0.1:{ollama_port}"
+    backend_url = f"http://127.0.0.1:{backend_port}"
+    fake_ollama_args = [
+        "--port", str(ollama_port),
+        "--token-rate", str(args.token_rate),
+        "--chunk-tokens", str(args.chunk_tokens),
+        "--response-tokens", str(args.response_tokens),
+        "--first-token-delay", str(args.first_token_delay),
+        "--models", args.models,
+    ]
+    backend_args = ["--port", str(backend_port), "--ollama-host", ollama_url]
+    if args.mongo_url:
+        backend_args += ["--mongo-url", args.mongo_url]
+
+    with open(args.log, "w") as log:
+        ollama_process = await start_process("fake_ollama.py", fake_ollama_args, log)
+        backend_process = await start_process("offline_backend.py", backend_args, log)
+        try:
+            await wait_until_ready(f"{ollama_url}/api/tags", ollama_process)
+            await wait_until_ready(f"{backend_url}/health", backend_process)
+            results = await run_workloads(args, backend_url, ollama_url)
+        finally:
+            await stop_process(backend_process)
+            await stop_process(ollama_process)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare", "log", "keep_chats")}
+    return {
+        "created_at": datetime.now().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        **results,
+    }
+
+
+def lookup(result: dict, path: str):
+    value = result
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(baseline: dict, current: dict):
+    if baseline.get("config") != current.get("config"):
+        print("warning: the baseline was recorded with a different configuration")
+    print(f"{'metric':<28} {'baseline':>12} {'current':>12} {'change':>9}")
+    for path, lower_is_better in HEADLINE_METRICS:
+        before, after = lookup(baseline, path), lookup(current, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        better = change < 0 if lower_is_better else change > 0
+        marker = "" if abs(change) < 1 else (" better" if better else " worse")
+        print(f"{path:<28} {before:>12.2f} {after:>12.2f} {change:>+8.1f}%{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=8, help="Concurrent chats streaming")
+    parser.add_argument("--turns", type=int, default=3, help="Turns per chat")
+    parser.add_argument("--history", type=int, default=60, help="Messages each chat is seeded with")
+    parser.add_argument("--protocol", type=int, default=1, choices=(1, 2), help="Stream protocol")
+    parser.add_argument("--readers", type=int, default=2, help="Clients reading chats during the streams")
+    parser.add_argument("--memory-clients", type=int, default=1, help="Clients updating memory during the streams")
+    parser.add_argument("--mongo-url", help="Local MongoDB instead of the in-process mongomock database")
+    add_fake_ollama_arguments(parser)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    parser.add_argument("--log", default=os.devnull, help="File for the output of the started servers")
+    parser.add_argument("--keep-chats", action="store_true", help="Do not delete the benchmark chats")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps({key: result[key] for key in ("wall_seconds", "stream", "chats", "memory", "backend")}, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Measure per-chunk allocation and time of the section pipeline of a stream.
+
+Runs offline, no Ollama or MongoDB needed. From the synpt-ai-api directory:
+
+    python benchmarks/section_allocations.py --blocks 40 --chunk 8
+
+A synthetic answer with text, code blocks and tables is fed in small chunks
+through IncrementalContentParser. For every chunk the sections are converted
+for the DB write and serialised into a legacy SSE payload, as
+stream_model_response does. The script reports the mean peak of transient
+allocations per chunk (tracemalloc), the memory retained by the final section
+list, the mean SSE payload size and the time per chunk without tracing.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import IncrementalContentParser, sections_to_dicts  # noqa: E402
+
+
+def synthetic_answer(blocks: int) -> str:
+    parts = []
+    for i in range(blocks):
+        parts.append(f"## Step {i}\nThis step explains **part {i}** of the solution in some detail.\n")
+        parts.append(f"```python\ndef step_{i}(value):\n    return value * {i}\n```\n")
+        parts.append("| Input | Output |\n|---|---|\n" + "".join(f"| {n} | {n * i} |\n" for n in range(5)))
+        parts.append("- first point\n- second point\n\n")
+    return "".join(parts)
+
+
+def chunks_of(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def process_chunk(parser: IncrementalContentParser, delta: str, accumulated: str) -> int:
+    sections = parser.feed(delta)
+    sections_to_dicts(sections)  # DB write
+    payload = json.dumps({
+        "content": delta,
+        "accumulated_content": accumulated,
+        "sections": sections_to_dicts(sections),
+        "status": "streaming",
+    })
+    return len(payload)
+
+
+def measure(chunks):
+    parser = IncrementalContentParser()
+    accumulated = ""
+    peaks = []
+    payload_bytes = 0
+    tracemalloc.start()
+    for delta in chunks:
+        accumulated += delta
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        payload_bytes += process_chunk(parser, delta, accumulated)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    parser = IncrementalContentParser()
+    for delta in chunks:
+        parser.feed(delta)
+    sections = parser.sections
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    parser = IncrementalContentParser()
+    accumulated = ""
+    started = time.perf_counter()
+    for delta in chunks:
+        accumulated += delta
+        process_chunk(parser, delta, accumulated)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "chunks": len(chunks),
+        "sections": len(sections),
+        "peak_alloc_per_chunk_kb": sum(peaks) / len(peaks) / 1024,
+        "retained_sections_kb": (retained - baseline) / 1024,
+        "payload_per_chunk_kb": payload_bytes / len(chunks) / 1024,
+        "time_per_chunk_us": elapsed / len(chunks) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=40, help="Text/code/table blocks in the synthetic answer")
+    parser.add_argument("--chunk", type=int, default=8, help="Characters per streamed chunk")
+    args = parser.parse_args()
+
+    result = measure(chunks_of(synthetic_answer(args.blocks), args.chunk))
+    print(json.dumps({key: round(value, 2) for key, value in result.items()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Measure time to first token across long chats for the configured context layout.
+
+Start the backend once per layout and run the script against each:
+
+    CONTEXT_LAYOUT=memories_first uvicorn main:app --port 8000
+    python benchmarks/ttft_context_layouts.py --model llama3.2 --turns 50
+
+    CONTEXT_LAYOUT=stable_prefix uvicorn main:app --port 8000
+    python benchmarks/ttft_context_layouts.py --model llama3.2 --turns 50
+
+Each run plays a scripted conversation of ``--turns`` turns and records, per
+turn, the time from sending the request to the first streamed token. With a
+stable prompt prefix Ollama can reuse its KV cache, so TTFT should stay flat
+as the chat grows instead of increasing with its length.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from datetime import datetime
+
+import httpx
+
+from _common import percentile
+
+TOPICS = [
+    "the borrow checker in Rust", "Python generators", "B-tree indexes", "TCP congestion control",
+    "CSS grid layouts", "garbage collection in the JVM", "MongoDB aggregation pipelines",
+    "Angular signals", "SQL window functions", "consistent hashing",
+]
+
+
+async def time_to_first_token(client: httpx.AsyncClient, chat_id: str, prompt: str) -> float:
+    started = time.perf_counter()
+    first_token = None
+    params = {"prompt": prompt, "chat_id": chat_id}
+    async with client.stream("GET", "/stream-generate", params=params) as response:
+        async for line in response.aiter_lines():
+            if first_token is None and line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if data.get("content") or data.get("delta"):
+                    first_token = time.perf_counter() - started
+    return (first_token if first_token is not None else time.perf_counter() - started) * 1000
+
+
+async def run(args):
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=httpx.Timeout(None)) as client:
+        health = (await client.get("/health")).json()
+        layout = health.get("context_layout", "unknown")
+
+        now = datetime.now().isoformat()
+        response = await client.post("/chats", json={
+            "title": f"ttft benchmark ({layout})",
+            "messages": [],
+            "created_at": now,
+            "updated_at": now,
+            "model": {"name": args.model, "size": 0}
+        })
+        response.raise_for_status()
+        chat_id = response.json()["id"]
+
+        timings = []
+        try:
+            for turn in range(args.turns):
+                topic = TOPICS[turn % len(TOPICS)]
+                prompt = f"In two sentences, what is important about {topic}? (turn {turn + 1})"
+                ttft = await time_to_first_token(client, chat_id, prompt)
+                timings.append(ttft)
+                print(f"turn {turn + 1:3d}: ttft={ttft:8.1f}ms")
+        finally:
+            if not args.keep_chat:
+                await client.delete(f"/chats/{chat_id}")
+
+    first, last = timings[:10], timings[-10:]
+    summary = {
+        "layout": layout,
+        "model": args.model,
+        "turns": len(timings),
+        "ttft_ms": {
+            "mean": statistics.mean(timings),
+            "p50": percentile(timings, 50),
+            "p95": percentile(timings, 95),
+            "first_10_mean": statistics.mean(first),
+            "last_10_mean": statistics.mean(last),
+        },
+        "per_turn_ms": timings,
+    }
+    print(json.dumps({key: value for key, value in summary.items() if key != "per_turn_ms"}, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(summary, output, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--model", required=True, help="Installed Ollama model")
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--output", help="Write the per-turn timings as JSON to this file")
+    parser.add_argument("--keep-chat", action="store_true", help="Do not delete the benchmark chat")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
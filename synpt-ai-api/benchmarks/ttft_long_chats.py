@@ -0,0 +1,98 @@
+"""Measure time to first token and completion lag on long chats.
+
+Run against a live backend (uvicorn main:app) with Ollama available, once on
+the old and once on the new code:
+
+    python benchmarks/ttft_long_chats.py --model llama3.2 --history 120 --turns 10
+
+The script creates a chat seeded with ``--history`` messages, so the context
+needs memory retrieval, then plays ``--turns`` turns. Per turn it records the
+time to the first streamed token and the lag between the last token and the
+completion event. Memory indexing and retrieval sitting on the critical path
+show up in the first number (retrieval before the model call) and the second
+(indexing before the completion event).
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from datetime import datetime
+
+import httpx
+
+from _common import percentile, seeded_history
+
+
+async def timed_turn(client: httpx.AsyncClient, chat_id: str, prompt: str):
+    started = time.perf_counter()
+    first_token = last_token = completed = None
+    params = {"prompt": prompt, "chat_id": chat_id}
+    async with client.stream("GET", "/stream-generate", params=params) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[len("data:"):])
+            now = time.perf_counter()
+            if data.get("status") == "complete":
+                completed = now
+            elif data.get("content") or data.get("delta"):
+                first_token = first_token or now
+                last_token = now
+    ttft = ((first_token or time.perf_counter()) - started) * 1000
+    completion_lag = ((completed - last_token) * 1000) if completed and last_token else 0.0
+    return ttft, completion_lag
+
+
+async def run(args):
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=httpx.Timeout(None)) as client:
+        now = datetime.now().isoformat()
+        response = await client.post("/chats", json={
+            "title": "ttft long chat benchmark",
+            "messages": seeded_history(args.history),
+            "created_at": now,
+            "updated_at": now,
+            "model": {"name": args.model, "size": 0}
+        })
+        response.raise_for_status()
+        chat_id = response.json()["id"]
+
+        ttfts, lags = [], []
+        try:
+            for turn in range(args.turns):
+                prompt = f"Briefly, what did we say about topic {turn % 9}? (turn {turn + 1})"
+                ttft, lag = await timed_turn(client, chat_id, prompt)
+                ttfts.append(ttft)
+                lags.append(lag)
+                print(f"turn {turn + 1:3d}: ttft={ttft:8.1f}ms completion_lag={lag:7.1f}ms")
+        finally:
+            if not args.keep_chat:
+                await client.delete(f"/chats/{chat_id}")
+
+    summary = {
+        "model": args.model,
+        "history": args.history,
+        "turns": len(ttfts),
+        "ttft_ms": {"mean": statistics.mean(ttfts), "p50": percentile(ttfts, 50), "p95": percentile(ttfts, 95)},
+        "completion_lag_ms": {"mean": statistics.mean(lags), "p95": percentile(lags, 95)},
+        "per_turn": [{"ttft_ms": ttft, "completion_lag_ms": lag} for ttft, lag in zip(ttfts, lags)],
+    }
+    print(json.dumps({key: value for key, value in summary.items() if key != "per_turn"}, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(summary, output, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--model", required=True, help="Installed Ollama model")
+    parser.add_argument("--history", type=int, default=120, help="Messages the chat is seeded with")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--output", help="Write the per-turn timings as JSON to this file")
+    parser.add_argument("--keep-chat", action="store_true", help="Do not delete the benchmark chat")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 from sse_starlette.sse import EventSourceResponse
 import ollama
 import json
@@ -9,18 +9,28 @@ import asyncio
 from datetime import datetime
 import certifi
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure
 from bson import ObjectId
 # import hashlib
 import re
 # from collections import defaultdict
 import logging
 import os
+import time
+import math
+import heapq
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from bisect import bisect_left
+from functools import wraps
 # from Crypto.Cipher import AES
 # from Crypto.Hash import MD5
-# import base64
+import base64
 # from typing import Union
-import subprocess
-from fastapi.responses import JSONResponse
+import httpx
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -47,6 +57,19 @@ db = client.ai_chat_db
 chats_collection = db.chats
 memories_collection = db.chat_memories
 
+# Ollama Configuration
+OLLAMA_HOST = os.getenv("OLLAMA_HOST")  # None falls back to the library default (localhost:11434)
+OLLAMA_MAX_CONNECTIONS = 32             # Size of the pooled HTTP connection set to Ollama
+
+# Shared non-blocking client; keeps HTTP connections to Ollama alive across requests
+ollama_client = ollama.AsyncClient(
+    host=OLLAMA_HOST,
+    limits=httpx.Limits(
+        max_connections=OLLAMA_MAX_CONNECTIONS,
+        max_keepalive_connections=OLLAMA_MAX_CONNECTIONS
+    )
+)
+
 # CORS setup
 app.add_middleware(
     CORSMiddleware,
@@ -59,9 +82,70 @@ app.add_middleware(
 
 # Configuration
 TEMPERATURE = 0
-MAX_CONTEXT_MESSAGES = 15  # Maximum recent messages to include
+MAX_CONTEXT_MESSAGES = 50  # Upper bound on recent messages considered; the token budget decides how many fit
+MAX_CONTEXT_MEMORIES = 3   # Maximum memories of older messages to include
+DEFAULT_CONTEXT_TOKENS = 4096  # Context window used for models not listed below
+MODEL_CONTEXT_TOKENS: Dict[str, int] = {}  # Per-model context window, e.g. {"llama3.2": 8192}
+RESPONSE_TOKEN_RESERVE = 1024  # Tokens kept free for the model's answer
+MIN_TRUNCATED_TOKENS = 64      # Smaller leftovers are dropped rather than truncated
+TOKEN_COUNT_CACHE_SIZE = 8192  # Cached per-message token estimates
+TOKEN_ESTIMATE_PATTERN = re.compile(r'\w{1,4}|[^\w\s]')
+# 'memories_first': memories, then recent history (original layout).
+# 'stable_prefix': optional system prompt and history first, memories right before the prompt,
+# so consecutive turns share a prompt prefix and Ollama can reuse its KV cache.
+CONTEXT_LAYOUT = os.getenv("CONTEXT_LAYOUT", "memories_first")
+CONTEXT_PREFIX_STEP = 8   # stable_prefix: the history window start only moves in steps of this many messages
+SYSTEM_PROMPT: Optional[str] = os.getenv("SYSTEM_PROMPT")  # stable_prefix: fixed first message, if set
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # Keep the model (and its KV cache) loaded between turns
 MEMORY_SEARCH_LIMIT = 5    # Maximum relevant memory pieces to retrieve
 MIN_KEYWORD_MATCHES = 2    # Minimum keyword matches for relevance
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "keyword")  # 'keyword' or 'vector'
+VECTOR_DB_PATH = os.getenv("VECTOR_DB_PATH", "./vector_memory")  # Persistent local vector index
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+EMBEDDING_BATCH_SIZE = 32
+MIN_VECTOR_SIMILARITY = 0.25  # Minimum cosine similarity for a memory to be relevant
+MEMORY_INDEX_BUDGET_BYTES = 64 * 1024 * 1024  # Approx. memory for in-process keyword indexes
+MEMORY_INDEX_SLICE_MAX = 2 ** 31 - 1  # $slice length meaning "to the end of the messages"
+MEMORY_INDEX_DRAIN_TIMEOUT = 10.0     # Seconds shutdown waits for pending memory indexing
+BM25_K1 = 1.5
+BM25_B = 0.75
+STREAM_PROTOCOL_LEGACY = 1  # Every event carries the full accumulated content and sections
+STREAM_PROTOCOL_DELTA = 2   # Events carry the new text plus section patches
+STREAM_FLUSH_INTERVAL = 0.5  # Max seconds between DB writes of a streaming message
+STREAM_FLUSH_BYTES = 2048    # Max unpersisted characters before a DB write is forced
+CHAT_PAGE_MAX_SIZE = 100     # Upper bound for the paginated chat listing
+SECTION_PARSER_VERSION = 1   # Bump when parsing/rendering output changes; part of the section cache key
+SECTION_CACHE_BUDGET_BYTES = 32 * 1024 * 1024  # Approx. memory for cached rendered sections
+# Store rendered sections with each message ('true'), or only the raw text ('false');
+# without stored sections they are rendered (and cached) when a chat is read.
+STORE_SECTIONS = os.getenv("STORE_SECTIONS", "false").lower() == "true"
+# Opt-in replay of earlier answers for identical model + context (valid because TEMPERATURE is 0)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_MEMORY_BYTES = 16 * 1024 * 1024   # In-process LRU tier
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "./response_cache")  # On-disk tier, '' disables it
+RESPONSE_CACHE_DISK_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_REPLAY_CHUNK = 24       # Characters per replayed chunk
+RESPONSE_CACHE_REPLAY_DELAY = float(os.getenv("RESPONSE_CACHE_REPLAY_DELAY", "0.01"))  # Seconds between replayed chunks
+STREAM_QUEUE_SIZE = 64       # Model chunks buffered between the upstream read and the SSE stream
+GENERATION_CANCEL_TIMEOUT = 5.0  # Seconds a cancel request waits for the partial response to be stored
+GENERATION_CANCELLED_MARKER = '\n\n[Generation cancelled]'
+STREAM_END = object()        # Sentinel marking the end of a model stream
+STREAM_REPLAY_BYTES = 256 * 1024  # Protocol 2 event data kept per generation for clients that reconnect with Last-Event-ID
+STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", "15"))  # Seconds a generation runs on without any client
+STREAM_RETENTION = 60.0      # Seconds a finished generation stays resumable
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "4"))  # Model calls running at once
+MAX_GENERATIONS_PER_MODEL = int(os.getenv("MAX_GENERATIONS_PER_MODEL", "2"))    # Default per-model limit
+MODEL_GENERATION_LIMITS: Dict[str, int] = {}  # Per-model concurrency, e.g. {"llama3.2": 4}
+MODEL_CATALOG_TTL = 30.0          # Seconds the cached model list is served without a refresh
+MODEL_CATALOG_MAX_STALE = 600.0   # Seconds a stale model list may be served while refreshing
+OLLAMA_CLI_TIMEOUT = 30           # Seconds before `ollama list` is given up
+SCHEDULER_MAX_BYPASS = 4     # Times a queued request may be overtaken by requests for an already loaded model
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+METRICS_LONG_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+METRICS_RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+METRICS_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+EVENT_LOOP_LAG_INTERVAL = 0.5  # Seconds between event-loop lag probes
 
 
 class ContentSection(BaseModel):
@@ -98,12 +182,319 @@ class Chat(BaseModel):
 class ChatResponse(Chat):
     id: str
 
+class ChatSummary(BaseModel):
+    id: str
+    title: str
+    model: ModelInfo
+    created_at: str
+    updated_at: str
+
+class ChatListPage(BaseModel):
+    chats: List[ChatSummary]
+    next_cursor: Optional[str] = None
+
+class MessageSections(BaseModel):
+    message_index: int
+    parser_version: int
+    sections: List[ContentSection]
+
 class EncryptedRequest(BaseModel):
     data: str
-class SimpleMemoryService:
-    """Simple memory service using keyword matching and text analysis"""
-    
+
+
+def content_hash(text: str) -> str:
+    """Stable hash of message content, used to detect unchanged messages"""
+    return sha256(text.encode('utf-8')).hexdigest()
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter in the Prometheus text format"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, *label_values):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_label_text(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge:
+    """Value read when metrics are scraped; ``collect`` returns {label values: value}"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, collect, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_label_text(self.labels, key)} {value}" for key, value in self.collect().items()]
+
+
+class Histogram:
+    """Bucketed distribution in the Prometheus text format (cumulative buckets, sum, count)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}  # label values -> [per-bucket counts (+Inf last), sum]
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-local metrics, rendered for /metrics"""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+generation_ttft = metrics.add(Histogram(
+    "synaptic_time_to_first_token_seconds", "Time from request to the first streamed token, including queueing", ("model",)))
+generation_duration = metrics.add(Histogram(
+    "synaptic_generation_duration_seconds", "Duration of stream_model_response (model calls, not cache replays)", ("model",), METRICS_LONG_BUCKETS))
+generation_token_rate = metrics.add(Histogram(
+    "synaptic_generation_tokens_per_second", "Streamed chunks per second after the first one", ("model",), METRICS_RATE_BUCKETS))
+generated_tokens = metrics.add(Counter(
+    "synaptic_generated_tokens_total", "Streamed model chunks (one token each)", ("model",)))
+generations_total = metrics.add(Counter(
+    "synaptic_generations_total", "Finished generations by outcome (complete, cancelled, error)", ("model", "outcome")))
+chunk_parse_time = metrics.add(Histogram(
+    "synaptic_chunk_parse_seconds", "Incremental section parsing per streamed chunk", ("model",), METRICS_FAST_BUCKETS))
+section_parse_time = metrics.add(Histogram(
+    "synaptic_section_parse_seconds", "ContentParsingService.parse_content_to_sections calls", (), METRICS_FAST_BUCKETS))
+stream_db_write_time = metrics.add(Histogram(
+    "synaptic_stream_db_write_seconds", "DB writes of a streaming message", ("model",)))
+stream_db_writes = metrics.add(Histogram(
+    "synaptic_stream_db_writes_per_generation", "DB writes made for one generation", ("model",), METRICS_COUNT_BUCKETS))
+context_build_time = metrics.add(Histogram(
+    "synaptic_context_build_seconds", "build_context_messages, including memory retrieval", ("model",)))
+memory_operation_time = metrics.add(Histogram(
+    "synaptic_memory_operation_seconds", "Memory service calls", ("backend", "operation")))
+memory_retrievals = metrics.add(Counter(
+    "synaptic_memory_retrievals_total", "Memory retrievals by result (hit: at least one memory found)", ("backend", "result")))
+memories_retrieved = metrics.add(Counter(
+    "synaptic_memories_retrieved_total", "Memories returned by retrievals", ("backend",)))
+event_loop_lag = metrics.add(Histogram(
+    "synaptic_event_loop_lag_seconds", "Delay of the event loop waking a sleeping task", (), METRICS_FAST_BUCKETS))
+
+
+def timed_memory_call(operation: str):
+    """Record latency (and for retrievals, hits) of a memory backend method"""
+    def decorate(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await method(self, *args, **kwargs)
+            finally:
+                memory_operation_time.observe(time.perf_counter() - started, self.memory_type, operation)
+            if operation == "retrieve":
+                memory_retrievals.inc(1, self.memory_type, "hit" if result else "miss")
+                memories_retrieved.inc(len(result), self.memory_type)
+            return result
+        return wrapper
+    return decorate
+
+
+async def monitor_event_loop_lag(interval: float = EVENT_LOOP_LAG_INTERVAL):
+    """Sleep ``interval`` seconds over and over and record how late each wake-up is"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(loop.time() - started - interval, 0.0))
+
+
+class MemoryBackend(ABC):
+    """Interface implemented by every chat memory backend"""
+
+    memory_type = "none"
+
+    @abstractmethod
+    async def store_conversation_memory(self, chat_id: str, messages: List[dict], start_index: int = 0):
+        """Index the messages of a chat so they can be retrieved later.
+
+        ``messages`` starts at ``start_index`` in the chat. With ``start_index=0``
+        it is the full history and memories of messages past its end are removed;
+        otherwise only the given messages are (re-)indexed.
+        """
+
+    @abstractmethod
+    async def retrieve_relevant_memory(self, chat_id: str, query: str, limit: int = MEMORY_SEARCH_LIMIT) -> List[dict]:
+        """Return memory dicts (message_index, content, type, timestamp, relevance_score), best first"""
+
+    @abstractmethod
+    async def delete_chat_memory(self, chat_id: str):
+        """Delete all memory for a specific chat"""
+
+    @abstractmethod
+    async def count_memories(self, chat_id: str) -> int:
+        """Number of stored memories for a chat"""
+
+
+class ChatKeywordIndex:
+    """In-memory inverted index with BM25 scoring for the memories of one chat"""
+
     def __init__(self):
+        self.docs: Dict[int, dict] = {}                  # message_index -> memory fields + term counts
+        self.postings: Dict[str, Dict[int, int]] = {}    # term -> {message_index: term frequency}
+        self.total_length = 0
+        self.size_bytes = 0
+
+    @staticmethod
+    def _doc_size(doc: dict) -> int:
+        # Rough footprint: the content string plus one dict entry per posting
+        return 200 + len(doc['content']) + 100 * len(doc['terms'])
+
+    def add(self, message_index: int, memory: dict, terms: List[str]):
+        """Index (or re-index) one message; ``terms`` keeps duplicates for term frequency"""
+        self.remove(message_index)
+
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[message_index] = count
+
+        doc = {**memory, "message_index": message_index, "terms": counts, "length": len(terms)}
+        self.docs[message_index] = doc
+        self.total_length += doc['length']
+        self.size_bytes += self._doc_size(doc)
+
+    def remove(self, message_index: int):
+        doc = self.docs.pop(message_index, None)
+        if doc is None:
+            return
+        for term in doc['terms']:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(message_index, None)
+                if not posting:
+                    del self.postings[term]
+        self.total_length -= doc['length']
+        self.size_bytes -= self._doc_size(doc)
+
+    def search(self, query_terms: List[str], limit: int) -> List[tuple]:
+        """Return ``(score, doc)`` pairs ranked by BM25"""
+        if not self.docs:
+            return []
+
+        doc_count = len(self.docs)
+        avg_length = self.total_length / doc_count or 1
+        scores: Dict[int, float] = {}
+        for term in set(query_terms):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for message_index, tf in posting.items():
+                length = self.docs[message_index]['length']
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[message_index] = scores.get(message_index, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(score, self.docs[message_index]) for message_index, score in ranked]
+
+
+class MemoryIndexCache:
+    """LRU of per-chat keyword indexes bounded by an approximate memory budget"""
+
+    def __init__(self, budget_bytes: int = MEMORY_INDEX_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self._indexes: "OrderedDict[str, ChatKeywordIndex]" = OrderedDict()
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(index.size_bytes for index in self._indexes.values())
+
+    def get(self, chat_id: str) -> Optional[ChatKeywordIndex]:
+        index = self._indexes.get(chat_id)
+        if index is not None:
+            self._indexes.move_to_end(chat_id)
+        return index
+
+    def put(self, chat_id: str, index: ChatKeywordIndex):
+        self._indexes[chat_id] = index
+        self._indexes.move_to_end(chat_id)
+        self.evict()
+
+    def pop(self, chat_id: str):
+        self._indexes.pop(chat_id, None)
+
+    def evict(self):
+        """Drop least recently used chats until the budget is met (the newest one always stays)"""
+        total = self.size_bytes
+        while total > self.budget_bytes and len(self._indexes) > 1:
+            chat_id, index = self._indexes.popitem(last=False)
+            total -= index.size_bytes
+            logger.info(f"Evicted memory index for chat {chat_id} ({index.size_bytes} bytes)")
+
+
+class SimpleMemoryService(MemoryBackend):
+    """Simple memory service using keyword matching and BM25 ranking.
+
+    ``chat_memories`` stays the source of truth; each chat gets an in-process
+    inverted index that is hydrated lazily from it and kept up to date as
+    messages are stored, so retrieval needs no database round trip.
+    """
+
+    memory_type = "keyword_based"
+    
+    def __init__(self, index_budget_bytes: int = MEMORY_INDEX_BUDGET_BYTES):
         self.stop_words = {
             'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from',
             'has', 'he', 'in', 'is', 'it', 'its', 'of', 'on', 'that', 'the',
@@ -112,84 +503,141 @@ class SimpleMemoryService:
             'could', 'would', 'should', 'do', 'did', 'have', 'had', 'my',
             'your', 'his', 'her', 'our', 'their'
         }
+        self.indexes = MemoryIndexCache(index_budget_bytes)
+        self._locks: Dict[str, asyncio.Lock] = {}
     
-    def extract_keywords(self, text: str) -> List[str]:
-        """Extract meaningful keywords from text"""
+    def tokenize(self, text: str) -> List[str]:
+        """Split text into meaningful terms, keeping repeats"""
         # Convert to lowercase and remove special characters
         text = re.sub(r'[^a-zA-Z0-9\s]', ' ', text.lower())
         words = text.split()
         
         # Filter out stop words and short words
-        keywords = [word for word in words 
-                   if word not in self.stop_words and len(word) > 2]
-        
-        return list(set(keywords))  # Remove duplicates
-    
-    def calculate_relevance_score(self, query_keywords: List[str], message_keywords: List[str]) -> float:
-        """Calculate relevance score based on keyword matching"""
-        if not query_keywords or not message_keywords:
-            return 0.0
-        
-        # Count matching keywords
-        matches = len(set(query_keywords) & set(message_keywords))
-        
-        # Calculate score as ratio of matches to query keywords
-        score = matches / len(query_keywords)
-        
-        return score
+        return [word for word in words
+                if word not in self.stop_words and len(word) > 2]
+
+    def extract_keywords(self, text: str) -> List[str]:
+        """Extract meaningful keywords from text"""
+        return list(set(self.tokenize(text)))  # Remove duplicates
     
-    async def store_conversation_memory(self, chat_id: str, messages: List[dict]):
-        """Store conversation messages with keyword indexing"""
-        try:
-            # Clear existing memories for this chat
-            await memories_collection.delete_many({"chat_id": chat_id})
-            
-            memory_docs = []
-            for idx, message in enumerate(messages):
-                if message['content'].strip():
-                    keywords = self.extract_keywords(message['content'])
-                    
-                    memory_doc = {
+    def _lock(self, chat_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(chat_id, asyncio.Lock())
+
+    async def _load_index(self, chat_id: str) -> ChatKeywordIndex:
+        """Return the chat index, hydrating it from chat_memories if it is not in memory.
+
+        Must be called with the chat lock held.
+        """
+        index = self.indexes.get(chat_id)
+        if index is None:
+            index = ChatKeywordIndex()
+            cursor = memories_collection.find(
+                {"chat_id": chat_id},
+                {"_id": 0, "message_index": 1, "content": 1, "type": 1, "timestamp": 1, "content_hash": 1}
+            )
+            async for doc in cursor:
+                index.add(doc['message_index'], self._memory_fields(chat_id, doc, doc.get('content_hash')),
+                          self.tokenize(doc['content']))
+            self.indexes.put(chat_id, index)
+            logger.info(f"Loaded memory index for chat {chat_id} ({len(index.docs)} memories)")
+        return index
+
+    @staticmethod
+    def _memory_fields(chat_id: str, message: dict, digest: Optional[str]) -> dict:
+        return {
+            "chat_id": chat_id,
+            "content": message['content'],
+            "type": message['type'],
+            "timestamp": message['timestamp'],
+            "content_hash": digest
+        }
+
+    @timed_memory_call("store")
+    async def store_conversation_memory(self, chat_id: str, messages: List[dict], start_index: int = 0):
+        """Incrementally index conversation messages with keywords.
+
+        New messages are appended, already indexed messages are only rewritten
+        when their content hash changed, and memories for messages that no
+        longer exist are removed.
+        """
+        async with self._lock(chat_id):
+            try:
+                index = await self._load_index(chat_id)
+
+                operations = []
+                stale_indexes = [idx for idx in index.docs if idx >= len(messages)] if start_index == 0 else []
+                indexed = []
+                for idx, message in enumerate(messages, start=start_index):
+                    if not message['content'].strip():
+                        if idx in index.docs:
+                            stale_indexes.append(idx)
+                        continue
+
+                    digest = content_hash(message['content'])
+                    if idx in index.docs and index.docs[idx]['content_hash'] == digest:
+                        continue  # Already indexed and unchanged
+
+                    terms = self.tokenize(message['content'])
+                    operations.append(UpdateOne(
+                        {"chat_id": chat_id, "message_index": idx},
+                        {
+                            "$set": {
+                                "content": message['content'],
+                                "type": message['type'],
+                                "timestamp": message['timestamp'],
+                                "content_hash": digest
+                            },
+                            "$setOnInsert": {"created_at": datetime.now().isoformat()}
+                        },
+                        upsert=True
+                    ))
+                    indexed.append((idx, self._memory_fields(chat_id, message, digest), terms))
+
+                if operations:
+                    await memories_collection.bulk_write(operations, ordered=False)
+                if stale_indexes:
+                    await memories_collection.delete_many({
                         "chat_id": chat_id,
-                        "message_index": idx,
-                        "content": message['content'],
-                        "type": message['type'],
-                        "timestamp": message['timestamp'],
-                        "keywords": keywords,
-                        "created_at": datetime.now().isoformat()
-                    }
-                    memory_docs.append(memory_doc)
-            
-            if memory_docs:
-                await memories_collection.insert_many(memory_docs)
-                logger.info(f"Stored {len(memory_docs)} memories for chat {chat_id}")
-            
-        except Exception as e:
-            logger.error(f"Error storing conversation memory: {str(e)}")
+                        "message_index": {"$in": stale_indexes}
+                    })
+
+                for idx, memory, terms in indexed:
+                    index.add(idx, memory, terms)
+                for idx in stale_indexes:
+                    index.remove(idx)
+                self.indexes.evict()
+
+                if operations or stale_indexes:
+                    logger.info(
+                        f"Indexed {len(operations)} memories and removed {len(stale_indexes)} "
+                        f"for chat {chat_id} ({len(index.docs)} total)"
+                    )
+
+            except Exception as e:
+                # Force a reload from the database on the next call
+                self.indexes.pop(chat_id)
+                logger.error(f"Error storing conversation memory: {str(e)}")
     
+    @timed_memory_call("retrieve")
     async def retrieve_relevant_memory(self, chat_id: str, query: str, limit: int = MEMORY_SEARCH_LIMIT) -> List[dict]:
-        """Retrieve relevant memories based on keyword matching"""
+        """Retrieve relevant memories ranked by BM25 over the chat's inverted index"""
         try:
-            query_keywords = self.extract_keywords(query)
-            if not query_keywords:
+            query_terms = self.tokenize(query)
+            if not query_terms:
                 return []
             
-            # Find memories with matching keywords
-            memories = []
-            cursor = memories_collection.find({
-                "chat_id": chat_id,
-                "keywords": {"$in": query_keywords}
-            })
-            
-            async for memory in cursor:
-                relevance = self.calculate_relevance_score(query_keywords, memory['keywords'])
-                if relevance > 0:
-                    memory['relevance_score'] = relevance
-                    memories.append(memory)
+            # A loaded index is the last committed state: indexing only changes it after
+            # its writes, so only hydrating a missing index waits for the chat lock
+            index = self.indexes.get(chat_id)
+            if index is None:
+                async with self._lock(chat_id):
+                    index = await self._load_index(chat_id)
             
-            # Sort by relevance and limit results
-            memories.sort(key=lambda x: x['relevance_score'], reverse=True)
-            relevant_memories = memories[:limit]
+            relevant_memories = []
+            for score, doc in index.search(query_terms, limit):
+                memory = {key: value for key, value in doc.items() if key not in ('terms', 'length')}
+                memory['relevance_score'] = score
+                relevant_memories.append(memory)
             
             logger.info(f"Retrieved {len(relevant_memories)} relevant memories for chat {chat_id}")
             return relevant_memories
@@ -201,13 +649,383 @@ class SimpleMemoryService:
     async def delete_chat_memory(self, chat_id: str):
         """Delete all memory for a specific chat"""
         try:
+            self.indexes.pop(chat_id)
+            self._locks.pop(chat_id, None)
             result = await memories_collection.delete_many({"chat_id": chat_id})
             logger.info(f"Deleted {result.deleted_count} memories for chat {chat_id}")
         except Exception as e:
             logger.error(f"Error deleting chat memory: {str(e)}")
 
+    async def count_memories(self, chat_id: str) -> int:
+        return await memories_collection.count_documents({"chat_id": chat_id})
+
+
+class VectorMemoryService(MemoryBackend):
+    """Semantic memory service using sentence embeddings and a persistent local vector index.
+
+    Embeddings are cached by content hash in their own collection, so a message
+    is only ever embedded once, no matter how often a chat is re-indexed.
+    """
+
+    memory_type = "vector"
+
+    def __init__(self, path: str = VECTOR_DB_PATH, model_name: str = EMBEDDING_MODEL):
+        self.path = path
+        self.model_name = model_name
+        self._model = None
+        self._memories = None
+        self._embedding_cache = None
+        self._init_lock = threading.Lock()
+
+    def _ensure_ready(self):
+        """Load the embedding model and open the vector index on first use.
+
+        Called from worker threads (indexing and retrieval run concurrently), so the
+        first load is locked and ``_memories``, which marks the backend ready, is set last.
+        """
+        if self._memories is not None:
+            return
+        with self._init_lock:
+            if self._memories is not None:
+                return
+            # Heavy optional dependencies, only needed when this backend is selected
+            import chromadb
+            from sentence_transformers import SentenceTransformer
+
+            chroma = chromadb.PersistentClient(path=self.path)
+            self._model = SentenceTransformer(self.model_name)
+            self._embedding_cache = chroma.get_or_create_collection(f"embeddings_{self.model_name.replace('/', '_')}")
+            self._memories = chroma.get_or_create_collection(
+                "chat_memories", metadata={"hnsw:space": "cosine"}
+            )
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, reusing cached embeddings and batching the misses"""
+        hashes = [content_hash(text) for text in texts]
+        unique_hashes = list(dict.fromkeys(hashes))
+
+        cached = {}
+        if unique_hashes:
+            found = self._embedding_cache.get(ids=unique_hashes, include=["embeddings"])
+            cached = {id_: list(embedding) for id_, embedding in zip(found["ids"], found["embeddings"])}
+
+        missing = {h: text for h, text in zip(hashes, texts) if h not in cached}
+        if missing:
+            vectors = self._model.encode(
+                list(missing.values()),
+                batch_size=EMBEDDING_BATCH_SIZE,
+                normalize_embeddings=True
+            ).tolist()
+            self._embedding_cache.upsert(ids=list(missing.keys()), embeddings=vectors)
+            cached.update(zip(missing.keys(), vectors))
+            logger.info(f"Embedded {len(missing)} new texts ({len(texts) - len(missing)} cached)")
+
+        return [cached[h] for h in hashes]
+
+    def _store(self, chat_id: str, messages: List[dict], start_index: int):
+        self._ensure_ready()
+
+        existing = self._memories.get(
+            where={"$and": [{"chat_id": chat_id}, {"message_index": {"$gte": start_index}}]},
+            include=["metadatas"]
+        )
+        existing_hashes = {id_: meta.get("content_hash") for id_, meta in zip(existing["ids"], existing["metadatas"])}
+
+        ids, documents, metadatas, removed = [], [], [], []
+        for idx, message in enumerate(messages, start=start_index):
+            memory_id = f"{chat_id}:{idx}"
+            if not message['content'].strip():
+                if existing_hashes.pop(memory_id, None) is not None:
+                    removed.append(memory_id)
+                continue
+            digest = content_hash(message['content'])
+            if existing_hashes.pop(memory_id, None) == digest:
+                continue  # Unchanged message, already indexed
+            ids.append(memory_id)
+            documents.append(message['content'])
+            metadatas.append({
+                "chat_id": chat_id,
+                "message_index": idx,
+                "type": message['type'],
+                "timestamp": message['timestamp'],
+                "content_hash": digest
+            })
+
+        # With the full history, whatever is left no longer exists in the chat
+        if start_index == 0:
+            removed.extend(existing_hashes)
+        if removed:
+            self._memories.delete(ids=removed)
+
+        if ids:
+            self._memories.upsert(ids=ids, documents=documents, metadatas=metadatas, embeddings=self._embed(documents))
+            logger.info(f"Stored {len(ids)} vector memories for chat {chat_id}")
+
+    def _retrieve(self, chat_id: str, query: str, limit: int) -> List[dict]:
+        self._ensure_ready()
+
+        result = self._memories.query(
+            query_embeddings=self._embed([query]),
+            n_results=limit,
+            where={"chat_id": chat_id},
+            include=["documents", "metadatas", "distances"]
+        )
+
+        memories = []
+        for document, metadata, distance in zip(result["documents"][0], result["metadatas"][0], result["distances"][0]):
+            relevance = 1 - distance
+            if relevance >= MIN_VECTOR_SIMILARITY:
+                memories.append({**metadata, "content": document, "relevance_score": relevance})
+        return memories
+
+    def _delete(self, chat_id: str) -> int:
+        self._ensure_ready()
+        existing = self._memories.get(where={"chat_id": chat_id}, include=[])
+        if existing["ids"]:
+            self._memories.delete(ids=existing["ids"])
+        return len(existing["ids"])
+
+    def _count(self, chat_id: str) -> int:
+        self._ensure_ready()
+        return len(self._memories.get(where={"chat_id": chat_id}, include=[])["ids"])
+
+    @timed_memory_call("store")
+    async def store_conversation_memory(self, chat_id: str, messages: List[dict], start_index: int = 0):
+        """Store conversation messages in the vector index"""
+        try:
+            await asyncio.to_thread(self._store, chat_id, messages, start_index)
+        except Exception as e:
+            logger.error(f"Error storing vector memory: {str(e)}")
+
+    @timed_memory_call("retrieve")
+    async def retrieve_relevant_memory(self, chat_id: str, query: str, limit: int = MEMORY_SEARCH_LIMIT) -> List[dict]:
+        """Retrieve memories semantically similar to the query"""
+        try:
+            memories = await asyncio.to_thread(self._retrieve, chat_id, query, limit)
+            logger.info(f"Retrieved {len(memories)} relevant memories for chat {chat_id}")
+            return memories
+        except Exception as e:
+            logger.error(f"Error retrieving vector memory: {str(e)}")
+            return []
+
+    async def delete_chat_memory(self, chat_id: str):
+        """Delete all memory for a specific chat"""
+        try:
+            deleted = await asyncio.to_thread(self._delete, chat_id)
+            logger.info(f"Deleted {deleted} memories for chat {chat_id}")
+        except Exception as e:
+            logger.error(f"Error deleting vector memory: {str(e)}")
+
+    async def count_memories(self, chat_id: str) -> int:
+        return await asyncio.to_thread(self._count, chat_id)
+
+
+def create_memory_service(backend: str = MEMORY_BACKEND) -> MemoryBackend:
+    """Build the configured memory backend"""
+    if backend == "vector":
+        return VectorMemoryService()
+    if backend == "keyword":
+        return SimpleMemoryService()
+    raise ValueError(f"Unknown memory backend: {backend}")
+
 # Initialize memory service
-memory_service = SimpleMemoryService()
+memory_service = create_memory_service()
+
+
+class MemoryIndexQueue:
+    """Background memory indexing, kept off the request and streaming paths.
+
+    ``schedule`` only records that a chat's messages from ``start_index`` on need
+    (re-)indexing; requests for a chat that is already waiting are merged into one
+    job starting at the lowest index. A single worker reads the messages when the
+    job runs and hands them to the memory backend, so retrieval keeps using the
+    last committed index until then.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, int] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._running: Dict[str, asyncio.Event] = {}
+        self._worker: Optional[asyncio.Task] = None
+        self.jobs = 0
+        self.merged = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def schedule(self, chat_id: str, start_index: int = 0):
+        if chat_id in self._pending:
+            self._pending[chat_id] = min(self._pending[chat_id], start_index)
+            self.merged += 1
+            return
+        self._pending[chat_id] = start_index
+        if self._worker is None or self._worker.done():
+            # (Re)start the worker on the running loop, carrying over anything still pending
+            self._queue = asyncio.Queue()
+            for pending_chat_id in self._pending:
+                self._queue.put_nowait(pending_chat_id)
+            self._worker = asyncio.create_task(self._run())
+        else:
+            self._queue.put_nowait(chat_id)
+
+    async def discard(self, chat_id: str):
+        """Drop a chat's pending job and wait for a running one, e.g. before deleting its memory"""
+        self._pending.pop(chat_id, None)
+        running = self._running.get(chat_id)
+        if running:
+            await running.wait()
+
+    async def drain(self, timeout: Optional[float] = None):
+        """Wait until every scheduled job has run"""
+        if self._queue is not None:
+            await asyncio.wait_for(self._queue.join(), timeout)
+
+    async def close(self, timeout: float = MEMORY_INDEX_DRAIN_TIMEOUT):
+        try:
+            await self.drain(timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {len(self._pending)} memory index jobs pending")
+        if self._worker:
+            self._worker.cancel()
+
+    async def _run(self):
+        while True:
+            chat_id = await self._queue.get()
+            try:
+                if chat_id in self._pending:
+                    start_index = self._pending.pop(chat_id)
+                    self._running[chat_id] = asyncio.Event()
+                    await self._index(chat_id, start_index)
+            except Exception as e:
+                logger.error(f"Error indexing memory for chat {chat_id}: {str(e)}")
+            finally:
+                running = self._running.pop(chat_id, None)
+                if running:
+                    running.set()
+                self._queue.task_done()
+
+    async def _index(self, chat_id: str, start_index: int):
+        if start_index:
+            projection = {'messages': {'$slice': [start_index, MEMORY_INDEX_SLICE_MAX]}}
+        else:
+            projection = {'messages': 1}
+        chat = await chats_collection.find_one({'_id': ObjectId(chat_id)}, projection)
+        if not chat:
+            return
+        messages = chat.get('messages') or []
+        if start_index and not messages:
+            return
+        await memory_service.store_conversation_memory(chat_id, messages, start_index=start_index)
+        self.jobs += 1
+
+memory_index_queue = MemoryIndexQueue()
+
+
+# Header (group 1), numbered or bullet list marker at the start of a line. A marker
+# ending the line matches too: the original patterns then continue on the next line.
+MARKDOWN_LINE_MARKER = re.compile(r'(#{1,6})(?:\s|$)|(?:\d+\.|[-*])(?:\s|$)')
+
+
+CODE_BLOCK_PATTERN = re.compile(r'```(\w*)\n([\s\S]*?)```', re.MULTILINE)
+THINK_BLOCK_PATTERN = re.compile(r'<think>\n([\s\S]*?)\n</think>', re.MULTILINE)
+# Anything that keeps a paragraph from being settled prose: markers of code, think
+# and table sections, literal list tags and header/list markers without content
+PROSE_BLOCKER_PATTERN = re.compile(
+    r'```|<think>|</?li>|^[^\S\n]*\|[^\n]*\||^(?:#{1,6}|\d+\.|[-*])[^\S\n]*$', re.MULTILINE)
+BOLD_PATTERN = re.compile(r'\*\*(.*?)\*\*')
+ITALIC_PATTERN = re.compile(r'\*(.*?)\*')
+
+
+class RangeCursor:
+    """Membership tests against a union of half-open ranges, for non-decreasing positions.
+
+    Ranges must be sorted by start; overlapping ones are merged. Each query only
+    moves past ranges ending before it, so a whole scan costs O(positions + ranges).
+    """
+
+    def __init__(self, ranges: List[tuple]):
+        self._ranges: List[List[int]] = []
+        for start, end in ranges:
+            if self._ranges and start <= self._ranges[-1][1]:
+                self._ranges[-1][1] = max(self._ranges[-1][1], end)
+            else:
+                self._ranges.append([start, end])
+        self._index = 0
+
+    def contains(self, pos: int) -> bool:
+        while self._index < len(self._ranges) and self._ranges[self._index][1] <= pos:
+            self._index += 1
+        return self._index < len(self._ranges) and self._ranges[self._index][0] <= pos
+
+
+def _render_bold(line: str) -> str:
+    """Replace **text** pairs left to right, like re.sub(r'\*\*(.*?)\*\*') on a single line"""
+    parts = []
+    pos = 0
+    while True:
+        start = line.find('**', pos)
+        if start == -1:
+            break
+        end = line.find('**', start + 2)
+        if end == -1:
+            break
+        parts.append(line[pos:start])
+        parts.append('<strong>')
+        parts.append(line[start + 2:end])
+        parts.append('</strong>')
+        pos = end + 2
+    if not parts:
+        return line
+    parts.append(line[pos:])
+    return ''.join(parts)
+
+
+class ParsedSection:
+    """Internal, slotted form of a parsed section.
+
+    Parsing and streaming work on these; they become dicts shaped like
+    ``ContentSection`` only when written to the DB or sent to the client.
+    The dict is built once per section and reused, since sections are never mutated.
+    """
+
+    __slots__ = ('type', 'content', 'language', 'start_pos', 'end_pos', '_dict')
+
+    def __init__(self, type: str, content: str, start_pos: int, end_pos: int, language: Optional[str] = None):
+        self.type = type
+        self.content = content
+        self.language = language
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        self._dict = None
+
+    def __eq__(self, other):
+        if not isinstance(other, ParsedSection):
+            return NotImplemented
+        return (self.type, self.content, self.language, self.start_pos, self.end_pos) == \
+            (other.type, other.content, other.language, other.start_pos, other.end_pos)
+
+    def __repr__(self):
+        return f"ParsedSection({self.type!r}, {self.start_pos}-{self.end_pos}, {len(self.content)} chars)"
+
+    def shifted(self, offset: int) -> 'ParsedSection':
+        if not offset:
+            return self
+        return ParsedSection(self.type, self.content, self.start_pos + offset, self.end_pos + offset, self.language)
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self._dict is None:
+            self._dict = {
+                'type': self.type,
+                'content': self.content,
+                'language': self.language,
+                'metadata': {'start_pos': self.start_pos, 'end_pos': self.end_pos}
+            }
+        return self._dict
+
+
+def sections_to_dicts(sections: List[ParsedSection]) -> List[Dict[str, Any]]:
+    """Stored / streamed form of parsed sections"""
+    return [section.to_dict() for section in sections]
 
 
 class ContentParsingService:
@@ -224,8 +1042,9 @@ class ContentParsingService:
             'bold_text': r'\*\*(.*?)\*\*'
         }
     
-    def parse_content_to_sections(self, content: str) -> List[ContentSection]:
+    def parse_content_to_sections(self, content: str) -> List[ParsedSection]:
         """Parse content into structured sections"""
+        started = time.perf_counter()
         sections = []
         
         # Track processed content to avoid duplicates
@@ -251,32 +1070,21 @@ class ContentParsingService:
         sections.extend(text_sections)
         
         # Sort sections by their original position in content
-        sections.sort(key=lambda x: x.metadata.get('start_pos', 0) if x.metadata else 0)
+        sections.sort(key=lambda x: x.start_pos)
         
+        section_parse_time.observe(time.perf_counter() - started)
         return sections
     
     def _extract_code_blocks(self, content: str) -> Dict[str, Any]:
         """Extract code blocks from content"""
-        import re
         sections = []
         ranges = []
         
-        pattern = re.compile(r'```(\w*)\n([\s\S]*?)```', re.MULTILINE)
-        
-        for match in pattern.finditer(content):
+        for match in CODE_BLOCK_PATTERN.finditer(content):
             language = match.group(1) or 'text'
             code_content = match.group(2).strip()
             
-            section = ContentSection(
-                type='code',
-                content=code_content,
-                language=language,
-                metadata={
-                    'start_pos': match.start(),
-                    'end_pos': match.end(),
-                    'raw_content': match.group(0)
-                }
-            )
+            section = ParsedSection('code', code_content, match.start(), match.end(), language)
             
             sections.append(section)
             ranges.append((match.start(), match.end()))
@@ -285,105 +1093,67 @@ class ContentParsingService:
     
     def _extract_tables(self, content: str, processed_ranges: List[tuple]) -> Dict[str, Any]:
         """Extract tables from content"""
-        import re
         sections = []
         ranges = []
         
-        lines = content.split('\n')
+        processed = RangeCursor(sorted(processed_ranges))
         table_lines = []
         table_start_pos = 0
         in_table = False
         
         current_pos = 0
-        for i, line in enumerate(lines):
+        for line in content.split('\n'):
             line_start = current_pos
-            line_end = current_pos + len(line) + 1  # +1 for newline
             
-            # Check if this line is in a processed range
-            is_processed = any(start <= line_start < end for start, end in processed_ranges)
-            
-            if not is_processed and line.strip().startswith('|') and '|' in line.strip()[1:]:
+            # Lines starting inside a processed range (code blocks) are never table lines
+            stripped = line.strip()
+            if stripped.startswith('|') and '|' in stripped[1:] and not processed.contains(line_start):
                 if not in_table:
                     table_start_pos = line_start
                     in_table = True
                     table_lines = []
                 
                 table_lines.append(line)
-            else:
-                if in_table and table_lines:
-                    # Process the table
-                    table_content = '\n'.join(table_lines)
-                    table_html = self._convert_table_to_html(table_content)
-                    
-                    section = ContentSection(
-                        type='table',
-                        content=table_html,
-                        metadata={
-                            'start_pos': table_start_pos,
-                            'end_pos': line_start,
-                            'raw_content': table_content
-                        }
-                    )
-                    
-                    sections.append(section)
-                    ranges.append((table_start_pos, line_start))
-                    
-                    in_table = False
-                    table_lines = []
+            elif in_table:
+                sections.append(self._table_section(table_lines, table_start_pos, line_start))
+                ranges.append((table_start_pos, line_start))
+                in_table = False
+                table_lines = []
             
-            current_pos = line_end
+            current_pos += len(line) + 1  # +1 for newline
         
         # Handle table at end of content
         if in_table and table_lines:
-            table_content = '\n'.join(table_lines)
-            table_html = self._convert_table_to_html(table_content)
-            
-            section = ContentSection(
-                type='table',
-                content=table_html,
-                metadata={
-                    'start_pos': table_start_pos,
-                    'end_pos': len(content),
-                    'raw_content': table_content
-                }
-            )
-            
-            sections.append(section)
+            sections.append(self._table_section(table_lines, table_start_pos, len(content)))
             ranges.append((table_start_pos, len(content)))
         
         return {'sections': sections, 'ranges': ranges}
     
+    def _table_section(self, table_lines: List[str], start_pos: int, end_pos: int) -> ParsedSection:
+        table_html = self._convert_table_to_html('\n'.join(table_lines))
+        return ParsedSection('table', table_html, start_pos, end_pos)
+    
     def _extract_think_blocks(self, content: str, processed_ranges: List[tuple]) -> Dict[str, Any]:
         """Extract think blocks from content"""
-        import re
         sections = []
         ranges = []
         
-        pattern = re.compile(r'<think>\n([\s\S]*?)\n</think>', re.MULTILINE)
+        # Matches come in position order, so one cursor walks the processed ranges once
+        processed = RangeCursor(sorted(processed_ranges))
         
-        for match in pattern.finditer(content):
-            # Check if this match is in a processed range
-            is_processed = any(start <= match.start() < end for start, end in processed_ranges)
-            
-            if not is_processed:
+        for match in THINK_BLOCK_PATTERN.finditer(content):
+            # Skip matches starting in a processed range
+            if not processed.contains(match.start()):
                 think_content = match.group(1).strip()
                 
-                section = ContentSection(
-                    type='think',
-                    content=think_content,
-                    metadata={
-                        'start_pos': match.start(),
-                        'end_pos': match.end(),
-                        'raw_content': match.group(0)
-                    }
-                )
+                section = ParsedSection('think', think_content, match.start(), match.end())
                 
                 sections.append(section)
                 ranges.append((match.start(), match.end()))
         
         return {'sections': sections, 'ranges': ranges}
     
-    def _extract_text_sections(self, content: str, processed_ranges: List[tuple]) -> List[ContentSection]:
+    def _extract_text_sections(self, content: str, processed_ranges: List[tuple]) -> List[ParsedSection]:
         """Extract remaining text sections"""
         sections = []
         
@@ -400,14 +1170,7 @@ class ContentParsingService:
                     # Format the text content
                     formatted_content = self._format_text_content(text_content)
                     
-                    section = ContentSection(
-                        type='text',
-                        content=formatted_content,
-                        metadata={
-                            'start_pos': current_pos,
-                            'end_pos': start
-                        }
-                    )
+                    section = ParsedSection('text', formatted_content, current_pos, start)
                     sections.append(section)
             
             current_pos = end
@@ -418,14 +1181,7 @@ class ContentParsingService:
             if text_content:
                 formatted_content = self._format_text_content(text_content)
                 
-                section = ContentSection(
-                    type='text',
-                    content=formatted_content,
-                    metadata={
-                        'start_pos': current_pos,
-                        'end_pos': len(content)
-                    }
-                )
+                section = ParsedSection('text', formatted_content, current_pos, len(content))
                 sections.append(section)
         
         return sections
@@ -436,45 +1192,102 @@ class ContentParsingService:
         if not lines:
             return ""
         
-        html = '<div class="table-container"><table class="table table-bordered table-striped">'
+        html = ['<div class="table-container"><table class="table table-bordered table-striped">']
         
         # Process header
         if lines:
             header_cells = [cell.strip() for cell in lines[0].split('|') if cell.strip()]
             if header_cells:
-                html += '<thead><tr>'
+                html.append('<thead><tr>')
                 for cell in header_cells:
-                    html += f'<th>{self._process_table_cell(cell)}</th>'
-                html += '</tr></thead>'
+                    html.append(f'<th>{self._process_table_cell(cell)}</th>')
+                html.append('</tr></thead>')
         
         # Skip separator line (usually second line with ---)
         body_start = 2 if len(lines) > 1 and '---' in lines[1] else 1
         
         # Process body
         if len(lines) > body_start:
-            html += '<tbody>'
+            html.append('<tbody>')
             for line in lines[body_start:]:
                 cells = [cell.strip() for cell in line.split('|') if cell.strip()]
                 if cells:
-                    html += '<tr>'
+                    html.append('<tr>')
                     for cell in cells:
-                        html += f'<td>{self._process_table_cell(cell)}</td>'
-                    html += '</tr>'
-            html += '</tbody>'
+                        html.append(f'<td>{self._process_table_cell(cell)}</td>')
+                    html.append('</tr>')
+            html.append('</tbody>')
         
-        html += '</table></div>'
-        return html
+        html.append('</table></div>')
+        return ''.join(html)
     
     def _process_table_cell(self, content: str) -> str:
         """Process individual table cell content"""
         # Handle bold text
-        content = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', content)
+        content = BOLD_PATTERN.sub(r'<strong>\1</strong>', content)
         # Handle italic text
-        content = re.sub(r'\*(.*?)\*', r'<em>\1</em>', content)
+        content = ITALIC_PATTERN.sub(r'<em>\1</em>', content)
         return content
     
     def _format_text_content(self, text: str) -> str:
-        """Format regular text content"""
+        """Format regular text content in a single line-oriented pass.
+
+        Produces the same HTML as ``_format_text_content_regex``. Inputs that only
+        the regex cascade handles in its own peculiar way (literal ``<li>`` tags, or
+        a header/list marker with nothing after it on its line, which the patterns
+        join with the next line) are delegated to it.
+        """
+        if '<li>' in text or '</li>' in text:
+            return self._format_text_content_regex(text)
+        
+        lines = []
+        in_list = False   # Inside a run of list items separated only by blank lines
+        last_item = 0     # Index in ``lines`` of the last item of that run
+        
+        for line in text.split('\n'):
+            marker = MARKDOWN_LINE_MARKER.match(line)
+            if marker:
+                content = line[marker.end():].lstrip()
+                if not content:
+                    return self._format_text_content_regex(text)
+                if '**' in content:
+                    content = _render_bold(content)
+                
+                if marker.group(1):
+                    hashes = marker.group(1)
+                    line = f'<h{hashes}>{content}</h{hashes}>'
+                else:
+                    line = f'<li>{content}</li>' if in_list else f'<ul><li>{content}</li>'
+                    in_list = True
+                    last_item = len(lines)
+                    lines.append(line)
+                    continue
+            elif not line or line.isspace():
+                lines.append(line)
+                continue
+            elif '**' in line:
+                line = _render_bold(line)
+            
+            if in_list:
+                lines[last_item] += '</ul>'
+                in_list = False
+            lines.append(line)
+        
+        if in_list:
+            lines[last_item] += '</ul>'
+        
+        # Handle paragraphs (split by double newlines)
+        formatted_paragraphs = []
+        for para in '\n'.join(lines).split('\n\n'):
+            para = para.strip()
+            if para and not para.startswith('<'):
+                para = f'<p>{para}</p>'
+            formatted_paragraphs.append(para)
+        
+        return '\n'.join(formatted_paragraphs)
+    
+    def _format_text_content_regex(self, text: str) -> str:
+        """Format regular text content with the original regex cascade"""
         # Handle headers
         text = re.sub(r'^(#{1,6})\s+(.+)$', r'<h\1>\2</h\1>', text, flags=re.MULTILINE)
         
@@ -510,6 +1323,351 @@ class ContentParsingService:
 # Initialize the content parsing service
 content_parser = ContentParsingService()
 
+
+class SectionCache:
+    """LRU of rendered sections keyed by content hash and parser version.
+
+    Shared by the stream path (which stores the sections it already built) and
+    the read endpoints, so the same text is not parsed twice.
+    """
+
+    SECTION_OVERHEAD_BYTES = 200  # Rough per-section object cost on top of its content
+
+    def __init__(self, budget_bytes: int = SECTION_CACHE_BUDGET_BYTES, parser: ContentParsingService = content_parser):
+        self.budget_bytes = budget_bytes
+        self.parser = parser
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    @staticmethod
+    def key(content: str) -> str:
+        return f"{SECTION_PARSER_VERSION}:{content_hash(content)}"
+
+    def get(self, content: str) -> Optional[List[ParsedSection]]:
+        key = self.key(content)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def get_or_parse(self, content: str) -> List[ParsedSection]:
+        sections = self.get(content)
+        if sections is None:
+            sections = self.parser.parse_content_to_sections(content)
+            self._store(self.key(content), sections)
+        return sections
+
+    def put(self, content: str, sections: List[ParsedSection]):
+        """Remember sections that were already built for ``content``"""
+        key = self.key(content)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        else:
+            self._store(key, list(sections))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "size_bytes": self.size_bytes, "hits": self.hits, "misses": self.misses}
+
+    def _store(self, key: str, sections: List[ParsedSection]):
+        size = sum(len(section.content) + self.SECTION_OVERHEAD_BYTES for section in sections)
+        self._entries[key] = (sections, size)
+        self.size_bytes += size
+        while self.size_bytes > self.budget_bytes and len(self._entries) > 1:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size_bytes -= evicted_size
+
+section_cache = SectionCache()
+
+
+async def attach_rendered_sections(messages: List[dict]):
+    """Fill in ``sections`` of AI messages stored as raw text only.
+
+    Cache misses are parsed in a worker thread, so reading a long chat after a
+    restart does not stall the running streams.
+    """
+    misses = []
+    for message in messages:
+        if message.get('type') == 'ai' and 'sections' not in message:
+            sections = section_cache.get(message.get('content', ''))
+            if sections is None:
+                misses.append(message)
+            else:
+                message['sections'] = sections_to_dicts(sections)
+    if not misses:
+        return
+
+    contents = [message.get('content', '') for message in misses]
+    parsed = await asyncio.to_thread(lambda: [section_cache.parser.parse_content_to_sections(c) for c in contents])
+    for message, content, sections in zip(misses, contents, parsed):
+        section_cache.put(content, sections)
+        message['sections'] = sections_to_dicts(sections)
+
+
+class IncrementalContentParser:
+    """Stateful per-stream parser that only re-parses the open tail of the content.
+
+    Sections that can no longer change (closed code fences, tables and think
+    blocks, plus any text before them) are committed once; every subsequent
+    delta only re-parses the text after the last commit point. Inside the open
+    text run, complete paragraphs of plain prose are rendered once and only the
+    text after them is parsed again. The resulting section list is identical to
+    ``parse_content_to_sections`` on the full text.
+    """
+
+    _code_pattern = CODE_BLOCK_PATTERN
+    _think_pattern = THINK_BLOCK_PATTERN
+    _code_head = re.compile(r'\w*\n')
+    _word_run = re.compile(r'\w*')
+
+    def __init__(self, parser: ContentParsingService = content_parser):
+        self.parser = parser
+        self.content = ""
+        self._committed: List[ParsedSection] = []
+        self._tail_sections: List[ParsedSection] = []
+        self._offset = 0  # Absolute position where the open tail starts
+        self._prose_end = 0       # Position in the tail after the settled prose, 0 if there is none
+        self._prose_html = ""     # Rendering of the settled prose
+        self._prose_blocked = False  # The tail holds something other than prose, until the next commit
+
+    @property
+    def sections(self) -> List[ParsedSection]:
+        return self._committed + self._tail_sections
+
+    @property
+    def committed_count(self) -> int:
+        """Number of leading sections that are final and will never change"""
+        return len(self._committed)
+
+    def feed(self, delta: str) -> List[ParsedSection]:
+        """Append a streamed delta and return the sections for the whole content"""
+        if not delta:
+            return self.sections
+
+        self.content += delta
+        tail = self.content[self._offset:]
+        tail_sections, cut = self._parse_tail(tail)
+
+        if cut:
+            for section in tail_sections:
+                if section.start_pos < cut:
+                    self._committed.append(section.shifted(self._offset))
+            self._offset += cut
+            self._prose_end = 0
+            self._prose_blocked = False
+            tail_sections, _ = self._parse_tail(tail[cut:])
+
+        self._tail_sections = [section.shifted(self._offset) for section in tail_sections]
+        return self.sections
+
+    def _parse_tail(self, tail: str):
+        """Sections of the open tail and its commit point, skipping the settled prose"""
+        self._extend_prose(tail)
+        if not self._prose_end:
+            sections = self.parser.parse_content_to_sections(tail)
+            return sections, self._find_commit_point(tail, sections)
+
+        # The prose holds no code, table or think markers, so the rest parses on its own
+        start = self._prose_end
+        rest = tail[start:]
+        rest_sections = self.parser.parse_content_to_sections(rest)
+        cut = self._find_commit_point(rest, rest_sections)
+
+        # The text run opened by the prose continues up to the first other section
+        text_end = next((s.start_pos for s in rest_sections if s.type != 'text'), len(rest))
+        text = rest[:text_end].rstrip()
+        content = f"{self._prose_html}\n{self.parser._format_text_content(text)}" if text else self._prose_html
+        sections = [ParsedSection('text', content, 0, start + text_end)]
+        sections.extend(
+            s.shifted(start) for s in rest_sections
+            if s.type != 'text' or s.start_pos != 0
+        )
+        return sections, (cut + start if cut else 0)
+
+    def _extend_prose(self, tail: str):
+        """Render complete paragraphs of plain prose at the start of the tail once.
+
+        A paragraph boundary (a blank line) after a line that ends in a non-blank
+        character and is not a list item can be cut at: rendering the text before
+        and after it separately and joining them with a newline gives the same
+        HTML as rendering it whole.
+        """
+        if self._prose_blocked:
+            return
+        end = tail.rfind('\n\n', self._prose_end)
+        while end > self._prose_end and tail[end - 1] == '\n':
+            end -= 1
+        if end <= self._prose_end:
+            return
+
+        # The text run is stripped before rendering, so its first line starts at the first non-blank
+        paragraphs = tail[self._prose_end:end] if self._prose_end else tail[:end].lstrip()
+        line = paragraphs[paragraphs.rfind('\n') + 1:]
+        if not line or line[-1].isspace():
+            return
+        marker = MARKDOWN_LINE_MARKER.match(line)
+        if marker and not marker.group(1):
+            return  # A list item, later items may still join its list
+        if PROSE_BLOCKER_PATTERN.search(paragraphs):
+            self._prose_blocked = True
+            return
+
+        html = self.parser._format_text_content(paragraphs)
+        self._prose_html = f"{self._prose_html}\n{html}" if self._prose_end else html
+        self._prose_end = end + 2
+
+    def _find_commit_point(self, tail: str, sections: List[ParsedSection]) -> int:
+        """Return the furthest position in ``tail`` that no future delta can affect, or 0"""
+        ranges = sorted(
+            (s.start_pos, s.end_pos)
+            for s in sections if s.type != 'text'
+        )
+        if not ranges:
+            return 0
+
+        code_spans = [m.span() for m in self._code_pattern.finditer(tail)]
+        think_spans = [m.span() for m in self._think_pattern.finditer(tail)]
+
+        for cut in sorted({end for _, end in ranges}, reverse=True):
+            before = [r for r in ranges if r[0] < cut]
+            if any(end > cut for _, end in before) or before[-1][1] != cut:
+                continue
+            if any(start < cut < end for start, end in code_spans + think_spans):
+                continue
+            if self._has_open_marker(tail, cut, '```', code_spans, self._code_head):
+                continue
+            if self._has_open_marker(tail, cut, '<think>', think_spans, None):
+                continue
+            if not self._is_settled_non_table_line(tail, cut):
+                continue
+            return cut
+
+        return 0
+
+    @staticmethod
+    def _has_open_marker(tail: str, cut: int, marker: str, spans: List[tuple], head) -> bool:
+        """Check for an unmatched opening marker before ``cut`` that a later delta could close"""
+        pos = tail.find(marker)
+        while pos != -1 and pos < cut:
+            if not any(start <= pos < end for start, end in spans):
+                after = pos + len(marker)
+                if head is None:
+                    # '<think>' must be followed by a newline to open a block
+                    if after >= len(tail) or tail[after] == '\n':
+                        return True
+                else:
+                    # An unterminated language tag may still turn into an opening fence
+                    if head.match(tail, after) or IncrementalContentParser._word_run.fullmatch(tail, after):
+                        return True
+            pos = tail.find(marker, pos + 1)
+        return False
+
+    @staticmethod
+    def _is_settled_non_table_line(tail: str, pos: int) -> bool:
+        """True if the line starting at ``pos`` can never become a table row"""
+        line_end = tail.find('\n', pos)
+        line = tail[pos:] if line_end == -1 else tail[pos:line_end]
+        stripped = line.strip()
+        if line_end != -1:
+            return not (stripped.startswith('|') and '|' in stripped[1:])
+        return bool(stripped) and not stripped.startswith('|')
+
+class SectionDeltaEncoder:
+    """Builds versioned delta SSE payloads for a single stream.
+
+    The first event and the completion event carry a full snapshot; every other
+    event carries only the new text and section patches against the previous event:
+
+    - ``truncate``: drop sections from ``length`` onwards
+    - ``append``: cut section ``index`` content at ``at`` and append ``content``
+    - ``replace``: replace section ``index`` entirely
+    - ``open``: a new section was added at ``index``
+    - ``close``: section ``index`` is final and will no longer change
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self._snapshot_sent = False
+        self._sections: List[ParsedSection] = []
+        self._committed = 0
+
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    def snapshot(self, status: str, accumulated_content: str, sections: List[ParsedSection], **extra) -> dict:
+        """Full state event, used for the first message and on completion"""
+        self._sections = list(sections)
+        self._snapshot_sent = True
+        return {
+            "v": STREAM_PROTOCOL_DELTA,
+            "seq": self.next_seq(),
+            "status": status,
+            "snapshot": {
+                "accumulated_content": accumulated_content,
+                "sections": sections_to_dicts(sections)
+            },
+            **extra
+        }
+
+    def encode(self, delta: str, accumulated_content: str, sections: List[ParsedSection], committed_count: int) -> dict:
+        """Encode one streamed chunk as a delta against the previously sent state"""
+        # Queue position events take sequence numbers too, so track the snapshot itself
+        if not self._snapshot_sent:
+            payload = self.snapshot("streaming", accumulated_content, sections, delta=delta)
+            self._committed = committed_count
+            return payload
+
+        ops = self._diff(sections)
+        for index in range(self._committed, committed_count):
+            ops.append({"op": "close", "index": index})
+        self._committed = committed_count
+        self._sections = list(sections)
+
+        return {
+            "v": STREAM_PROTOCOL_DELTA,
+            "seq": self.next_seq(),
+            "status": "streaming",
+            "delta": delta,
+            "ops": ops
+        }
+
+    def _diff(self, sections: List[ParsedSection]) -> List[dict]:
+        previous = self._sections
+        ops = []
+        if len(previous) > len(sections):
+            ops.append({"op": "truncate", "length": len(sections)})
+
+        # Sections before the committed count are unchanged by construction
+        for index in range(self._committed, len(sections)):
+            new = sections[index]
+            if index >= len(previous):
+                ops.append({"op": "open", "index": index, "section": new.to_dict()})
+                continue
+
+            old = previous[index]
+            if old is new or old == new:
+                continue
+            if old.type == new.type and old.language == new.language:
+                at = len(os.path.commonprefix([old.content, new.content]))
+                op = {"op": "append", "index": index, "at": at, "content": new.content[at:]}
+                metadata = {}
+                if new.start_pos != old.start_pos:
+                    metadata["start_pos"] = new.start_pos
+                if new.end_pos != old.end_pos:
+                    metadata["end_pos"] = new.end_pos
+                if metadata:
+                    op["metadata"] = metadata
+                ops.append(op)
+            else:
+                ops.append({"op": "replace", "index": index, "section": new.to_dict()})
+
+        return ops
+
 # Utility functions
 def convert_objectid_to_str(chat):
     chat['id'] = str(chat['_id'])
@@ -559,35 +1717,141 @@ def convert_objectid_to_str(chat):
 # * ------------------------END------------------------ *
 
 
-async def build_context_messages(chat_history: List[dict], current_prompt: str, chat_id: str) -> List[dict]:
-    """Build optimized context using recent messages + relevant memories"""
+# Token estimates by content hash, so the cache does not keep whole messages alive
+_token_estimates: "OrderedDict[str, int]" = OrderedDict()
+
+def estimate_tokens(text: str) -> int:
+    """Fast local token estimate: words are split into 4-character pieces, punctuation counts alone"""
+    key = content_hash(text)
+    tokens = _token_estimates.get(key)
+    if tokens is not None:
+        _token_estimates.move_to_end(key)
+        return tokens
+    tokens = _token_estimates[key] = len(TOKEN_ESTIMATE_PATTERN.findall(text))
+    if len(_token_estimates) > TOKEN_COUNT_CACHE_SIZE:
+        _token_estimates.popitem(last=False)
+    return tokens
+
+TRUNCATION_MARKER = " ...[truncated]"
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most ``max_tokens`` estimated tokens (marker included), keeping the beginning"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    keep = max(max_tokens - estimate_tokens(TRUNCATION_MARKER), 0)
+    for pieces, match in enumerate(TOKEN_ESTIMATE_PATTERN.finditer(text)):
+        if pieces == keep:
+            return text[:match.start()].rstrip() + TRUNCATION_MARKER
+    return text
+
+def context_budget_for(model_name: Optional[str]) -> int:
+    """Context window (in tokens) configured for a model, matched by full name then base name"""
+    if model_name:
+        if model_name in MODEL_CONTEXT_TOKENS:
+            return MODEL_CONTEXT_TOKENS[model_name]
+        base_name = model_name.split(':')[0]
+        if base_name in MODEL_CONTEXT_TOKENS:
+            return MODEL_CONTEXT_TOKENS[base_name]
+    return DEFAULT_CONTEXT_TOKENS
+
+# Running totals of context packing decisions
+context_packing_stats = {
+    "contexts_built": 0,
+    "recent_messages_packed": 0,
+    "memories_packed": 0,
+    "messages_truncated": 0,
+    "memories_dropped": 0,
+    "tokens_packed": 0,
+}
+
+async def build_context_messages(chat_history: List[dict], current_prompt: str, chat_id: str, history_length: Optional[int] = None, model_name: Optional[str] = None, layout: Optional[str] = None) -> List[dict]:
+    """Build optimized context using recent messages + relevant memories within a token budget
+
+    ``chat_history`` only needs to hold the most recent messages; ``history_length``
+    is the total number of messages in the chat (defaults to ``len(chat_history)``).
+    Recent messages are packed newest first until the model's budget is used up,
+    then the best scoring memories of older messages fill what is left.
+    ``layout`` (default CONTEXT_LAYOUT) decides where memories go, see CONTEXT_LAYOUT.
+    """
+    started = time.perf_counter()
+    if history_length is None:
+        history_length = len(chat_history)
+    layout = layout or CONTEXT_LAYOUT
+    stable_prefix = layout == "stable_prefix"
+    system_prompt = SYSTEM_PROMPT if stable_prefix else None
+    
+    budget = context_budget_for(model_name) - RESPONSE_TOKEN_RESERVE - estimate_tokens(current_prompt)
+    if system_prompt:
+        budget -= estimate_tokens(system_prompt)
+    remaining = max(budget, 0)
+    truncated = 0
     
-    # Get recent messages (last N messages)
-    recent_messages = chat_history[-MAX_CONTEXT_MESSAGES:] if len(chat_history) > MAX_CONTEXT_MESSAGES else chat_history
+    # Pack recent messages, newest first, stopping at the first one that no longer fits
+    recent_messages = []
+    for msg in reversed(chat_history[-MAX_CONTEXT_MESSAGES:]):
+        tokens = estimate_tokens(msg["content"])
+        if tokens > remaining:
+            if not recent_messages and remaining >= MIN_TRUNCATED_TOKENS:
+                # Never drop the latest exchange entirely, shorten it instead
+                recent_messages.append({**msg, "content": truncate_to_tokens(msg["content"], remaining)})
+                truncated += 1
+                remaining = 0
+            break
+        recent_messages.append(msg)
+        remaining -= tokens
+    recent_messages.reverse()
+    
+    if stable_prefix and not truncated:
+        # Align the window start to a step boundary so it stays put for several turns
+        window_start = history_length - len(recent_messages)
+        aligned_start = -(-window_start // CONTEXT_PREFIX_STEP) * CONTEXT_PREFIX_STEP
+        drop = aligned_start - window_start
+        if 0 < drop < len(recent_messages):
+            remaining += sum(estimate_tokens(msg["content"]) for msg in recent_messages[:drop])
+            recent_messages = recent_messages[drop:]
     
     # Get relevant memories from older conversation
     relevant_memories = []
-    if len(chat_history) > MAX_CONTEXT_MESSAGES:
-        # Update memory with all messages
-        await memory_service.store_conversation_memory(chat_id, chat_history)
-        
+    dropped_memories = 0
+    older_count = history_length - len(recent_messages)
+    if older_count > 0 and remaining >= MIN_TRUNCATED_TOKENS:
         # Retrieve relevant memories based on current prompt
         memories = await memory_service.retrieve_relevant_memory(chat_id, current_prompt)
         
-        # Filter to only include memories from older messages
+        # Only memories from messages that are not already in the context, best score first
         for memory in memories:
-            if memory['message_index'] < len(chat_history) - MAX_CONTEXT_MESSAGES:
-                relevant_memories.append(memory)
+            if memory['message_index'] >= older_count:
+                continue
+            if len(relevant_memories) >= MAX_CONTEXT_MEMORIES:
+                break
+            content = f"[Previous Context] {memory['content']}"
+            tokens = estimate_tokens(content)
+            if tokens > remaining:
+                if remaining < MIN_TRUNCATED_TOKENS:
+                    dropped_memories += 1
+                    continue
+                content = truncate_to_tokens(content, remaining)
+                tokens = estimate_tokens(content)
+                truncated += 1
+            relevant_memories.append({**memory, "content": content})
+            remaining -= tokens
     
     # Combine recent messages with relevant memories
     context_messages = []
-    
-    # Add relevant memories first (as context)
-    for memory in relevant_memories[:3]:  # Limit to top 3 memories
-        context_messages.append({
+    memory_messages = [
+        {
             "role": "user" if memory["type"] == "user" else "assistant",
-            "content": f"[Previous Context] {memory['content']}"
-        })
+            "content": memory['content']
+        }
+        for memory in relevant_memories
+    ]
+    
+    if system_prompt:
+        context_messages.append({"role": "system", "content": system_prompt})
+    
+    # Add relevant memories first (as context), unless the prefix has to stay stable
+    if not stable_prefix:
+        context_messages.extend(memory_messages)
     
     # Add recent messages
     for msg in recent_messages:
@@ -596,6 +1860,24 @@ async def build_context_messages(chat_history: List[dict], current_prompt: str,
             "content": msg["content"]
         })
     
+    # Turn-specific memories go last, right before the prompt
+    if stable_prefix:
+        context_messages.extend(memory_messages)
+    
+    packed_tokens = max(budget, 0) - remaining
+    context_packing_stats["contexts_built"] += 1
+    context_packing_stats["recent_messages_packed"] += len(recent_messages)
+    context_packing_stats["memories_packed"] += len(relevant_memories)
+    context_packing_stats["messages_truncated"] += truncated
+    context_packing_stats["memories_dropped"] += dropped_memories
+    context_packing_stats["tokens_packed"] += packed_tokens
+    logger.info(
+        f"Context for chat {chat_id}: {len(recent_messages)}/{len(chat_history)} recent messages, "
+        f"{len(relevant_memories)} memories, {packed_tokens}/{budget} tokens, "
+        f"{truncated} truncated, {dropped_memories} memories dropped ({layout} layout)"
+    )
+    
+    context_build_time.observe(time.perf_counter() - started, model_name or "")
     return context_messages
 
 class EncryptedData(BaseModel):
@@ -619,12 +1901,84 @@ class EncryptedData(BaseModel):
 
 # ** API Func to test e2e encryption/decryption -------------END-----
 
+class ModelCatalogCache:
+    """Cached Ollama model list with a TTL and stale-while-revalidate refresh.
+
+    Fresh entries are served as-is. Stale entries (up to MODEL_CATALOG_MAX_STALE old)
+    are served immediately while a single background refresh runs; older or missing
+    entries wait for that refresh. The entry is invalidated when a refresh returns a
+    different model set or a chat uses a model the catalog does not list.
+    """
+
+    def __init__(self, ttl: float = MODEL_CATALOG_TTL, max_stale: float = MODEL_CATALOG_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._models = None
+        self._fingerprint: Optional[frozenset] = None
+        self._fetched_at = 0.0
+        self._refresh: Optional[asyncio.Task] = None
+
+    async def get(self):
+        age = time.monotonic() - self._fetched_at
+        if self._models is not None and age < self.ttl:
+            return self._models
+        refresh = self._start_refresh()
+        if self._models is not None and age < self.max_stale:
+            return self._models
+        return await asyncio.shield(refresh)
+
+    def invalidate(self):
+        self._fetched_at = 0.0
+
+    async def digest_for(self, model_name: str) -> Optional[str]:
+        """Digest of an installed model (a bare name matches its ':latest' tag)"""
+        models = await self.get()
+        for model in models['models']:
+            name = model.get('model') or model.get('name')
+            if name == model_name or name == f"{model_name}:latest":
+                return model.get('digest')
+        return None
+
+    def observe_model(self, model_name: str):
+        """Refresh in the background if a chat uses a model the catalog does not know"""
+        if self._fingerprint is not None and not any(name == model_name for name, _ in self._fingerprint):
+            logger.info(f"Model {model_name} not in the cached catalog, refreshing")
+            self.invalidate()
+            self._start_refresh()
+
+    def _start_refresh(self) -> asyncio.Task:
+        # Single flight: concurrent callers share the running refresh
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._fetch())
+            self._refresh.add_done_callback(self._log_refresh_error)
+        return self._refresh
+
+    async def _fetch(self):
+        models = await ollama_client.list()
+        fingerprint = frozenset(
+            (model.get('model') or model.get('name'), model.get('digest'))
+            for model in models['models']
+        )
+        if self._fingerprint is not None and fingerprint != self._fingerprint:
+            logger.info(f"Model list changed: {len(self._fingerprint)} -> {len(fingerprint)} models")
+        self._models = models
+        self._fingerprint = fingerprint
+        self._fetched_at = time.monotonic()
+        return models
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Error refreshing model catalog: {str(task.exception())}")
+
+model_catalog = ModelCatalogCache()
+
 @app.get("/models")
 async def list_ollama_models():
     """List all locally installed Ollama models"""
     try:
-        # Use ollama library instead of subprocess
-        models = ollama.list()
+        # Served from the model catalog cache, refreshed from ollama in the background
+        models = await model_catalog.get()
         return models
         
     except Exception as e:
@@ -641,11 +1995,10 @@ async def list_ollama_models():
         )
 
 # Alternative version if you want to keep using subprocess with better error handling
-# todo: Will implement later
 
 @app.get("/models-subprocess")
 async def list_ollama_models_subprocess():
-    """Alternative implementation using subprocess"""
+    """Alternative implementation using the ollama CLI"""
     try:
         import shutil
         
@@ -656,59 +2009,39 @@ async def list_ollama_models_subprocess():
                 content={"error": "Ollama CLI not found in PATH"}
             )
         
-        result = subprocess.run(
-            ["ollama", "list"],  # Remove --json flag first to see raw output
-            capture_output=True,
-            text=True,
-            timeout=30  # Add timeout
+        # `ollama list` has no JSON output, so one invocation is parsed as text
+        process = await asyncio.create_subprocess_exec(
+            "ollama", "list",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=OLLAMA_CLI_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return JSONResponse(
+                status_code=500,
+                content={"error": "Ollama command timed out"}
+            )
+        stdout = stdout.decode(errors="replace")
+        stderr = stderr.decode(errors="replace")
         
-        logger.info(f"Ollama command return code: {result.returncode}")
-        logger.info(f"Ollama stdout: {result.stdout}")
-        logger.info(f"Ollama stderr: {result.stderr}")
+        logger.info(f"Ollama command return code: {process.returncode}")
 
-        if result.returncode != 0:
+        if process.returncode != 0:
             return JSONResponse(
                 status_code=500,
                 content={
                     "error": "Ollama command failed",
-                    "return_code": result.returncode,
-                    "stderr": result.stderr,
-                    "stdout": result.stdout
+                    "return_code": process.returncode,
+                    "stderr": stderr,
+                    "stdout": stdout
                 }
             )
 
-        # Try with --json flag
-        result_json = subprocess.run(
-            ["ollama", "list", "--json"],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result_json.returncode == 0:
-            try:
-                models = json.loads(result_json.stdout)
-                return models
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON decode error: {e}")
-                return JSONResponse(
-                    status_code=500,
-                    content={
-                        "error": "Failed to parse JSON output",
-                        "raw_output": result_json.stdout,
-                        "json_error": str(e)
-                    }
-                )
-        else:
-            # Fallback: parse the regular output
-            return parse_ollama_list_output(result.stdout)
+        return parse_ollama_list_output(stdout)
 
-    except subprocess.TimeoutExpired:
-        return JSONResponse(
-            status_code=500,
-            content={"error": "Ollama command timed out"}
-        )
     except FileNotFoundError:
         return JSONResponse(
             status_code=500,
@@ -747,28 +2080,165 @@ async def create_chat(chat: Chat):
     chat_dict = chat.model_dump()
     chat_dict['created_at'] = datetime.now().isoformat()
     chat_dict['updated_at'] = chat_dict['created_at']
+    chat_dict['message_count'] = len(chat_dict['messages'])
 
     result = await chats_collection.insert_one(chat_dict)
     created_chat = await chats_collection.find_one({'_id': result.inserted_id})
     
+    # Index initial messages so later turns can find them through memory
+    if chat_dict['messages']:
+        memory_index_queue.schedule(str(result.inserted_id))
+    
     return convert_objectid_to_str(created_chat)
 
-@app.get("/chats", response_model=List[ChatResponse])
-async def get_chats():
-    chats = []
-    cursor = chats_collection.find().sort('updated_at', -1)
-    async for chat in cursor:
-        chats.append(convert_objectid_to_str(chat))
-    # encChats = encrypt(chats)
-    return chats
+def encode_chat_cursor(chat: dict) -> str:
+    """Opaque keyset cursor pointing just after ``chat`` in updated_at/_id order"""
+    raw = json.dumps({"u": chat['updated_at'], "i": str(chat['_id'])})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_chat_cursor(cursor: str) -> dict:
+    """Turn a listing cursor back into the Mongo filter for the next page"""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        updated_at, last_id = raw['u'], ObjectId(raw['i'])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {
+        "$or": [
+            {"updated_at": {"$lt": updated_at}},
+            {"updated_at": updated_at, "_id": {"$lt": last_id}}
+        ]
+    }
+
+@app.get("/chats", response_model=Union[ChatListPage, List[ChatResponse]])
+async def get_chats(limit: Optional[int] = Query(None, ge=1, le=CHAT_PAGE_MAX_SIZE), cursor: Optional[str] = None):
+    """List chats, newest first.
+
+    Without ``limit`` every chat is returned with all its messages (original
+    behaviour). With ``limit`` a page of summaries (id, title, model,
+    timestamps) is returned along with ``next_cursor`` for the following page.
+    """
+    if limit is None and cursor is None:
+        chats = []
+        chats_cursor = chats_collection.find().sort('updated_at', -1)
+        async for chat in chats_cursor:
+            chats.append(convert_objectid_to_str(chat))
+        # encChats = encrypt(chats)
+        return chats
+
+    query = decode_chat_cursor(cursor) if cursor else {}
+    page_size = limit or CHAT_PAGE_MAX_SIZE
+    projection = {"title": 1, "model": 1, "created_at": 1, "updated_at": 1}
+
+    # Fetch one extra document to know whether another page exists
+    documents = await chats_collection.find(query, projection) \
+        .sort([('updated_at', -1), ('_id', -1)]) \
+        .limit(page_size + 1) \
+        .to_list(length=page_size + 1)
+
+    next_cursor = None
+    if len(documents) > page_size:
+        documents = documents[:page_size]
+        next_cursor = encode_chat_cursor(documents[-1])
+
+    return ChatListPage(
+        chats=[convert_objectid_to_str(chat) for chat in documents],
+        next_cursor=next_cursor
+    )
+
+async def fetch_chat_window(chat_id: str, limit: int, before: Optional[int], include_sections: bool) -> Optional[dict]:
+    """Fetch chat metadata plus a window of ``limit`` messages ending before index ``before``.
+
+    The slicing (and dropping of ``sections``) happens in MongoDB so only the
+    window is transferred.
+    """
+    messages = {"$ifNull": ["$messages", []]}
+    if before is None:
+        window = {"$slice": [messages, -limit]}
+    elif before == 0:
+        window = {"$literal": []}
+    else:
+        # The first ``before`` messages (fewer if the chat is shorter), then the last ``limit`` of those
+        window = {"$slice": [{"$slice": [messages, before]}, -limit]}
+
+    pipeline = [
+        {"$match": {"_id": ObjectId(chat_id)}},
+        {"$project": {
+            "title": 1,
+            "model": 1,
+            "created_at": 1,
+            "updated_at": 1,
+            "message_count": {"$size": messages},
+            "messages": window
+        }}
+    ]
+    if not include_sections:
+        pipeline.append({"$project": {"messages.sections": 0}})
+
+    documents = await chats_collection.aggregate(pipeline).to_list(length=1)
+    if not documents:
+        return None
+
+    chat = documents[0]
+    end = chat['message_count'] if before is None else min(before, chat['message_count'])
+    start = end - len(chat['messages'])
+    # Index of the first returned message; older messages are fetched with before=<this value>
+    chat['window_start'] = start
+    chat['next_before'] = start if start > 0 else None
+    return chat
 
 @app.get("/chats/{chat_id}")
-async def get_chat(chat_id: str):
+async def get_chat(chat_id: str,
+                   limit: Optional[int] = Query(None, ge=1),
+                   before: Optional[int] = Query(None, ge=0),
+                   include_sections: bool = True):
+    """Get a chat.
+
+    Without ``limit`` the whole ``messages`` array is returned. With ``limit``
+    only the last ``limit`` messages before index ``before`` (default: the end)
+    are returned, together with ``message_count``, ``window_start`` and
+    ``next_before`` for loading older messages. ``include_sections=false``
+    leaves out the rendered sections of every message.
+    """
     try:
-        chat = await chats_collection.find_one({'_id': ObjectId(chat_id)})
+        if limit is not None:
+            chat = await fetch_chat_window(chat_id, limit, before, include_sections)
+        else:
+            projection = None if include_sections else {"messages.sections": 0}
+            chat = await chats_collection.find_one({'_id': ObjectId(chat_id)}, projection)
         if chat:
+            if include_sections:
+                await attach_rendered_sections(chat.get('messages', []))
             return convert_objectid_to_str(chat)
         raise HTTPException(status_code=404, detail="Chat not found")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/chats/{chat_id}/messages/{message_index}/sections", response_model=MessageSections)
+async def get_message_sections(chat_id: str, message_index: int):
+    """Rendered sections of one message, parsed on demand and served from the section cache"""
+    try:
+        if message_index < 0:
+            raise HTTPException(status_code=404, detail="Message not found")
+        chat = await chats_collection.find_one(
+            {'_id': ObjectId(chat_id)},
+            {'message_count': 1, 'messages': {'$slice': [message_index, 1]}}
+        )
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if not chat.get('messages'):
+            raise HTTPException(status_code=404, detail="Message not found")
+        
+        message = chat['messages'][0]
+        return {
+            "message_index": message_index,
+            "parser_version": SECTION_PARSER_VERSION,
+            "sections": sections_to_dicts(section_cache.get_or_parse(message.get('content', '')))
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -776,6 +2246,7 @@ async def get_chat(chat_id: str):
 async def update_chat(chat_id: str, chat: Chat):
     chat_dict = chat.dict()
     chat_dict['updated_at'] = datetime.now().isoformat()
+    chat_dict['message_count'] = len(chat_dict['messages'])
     
     result = await chats_collection.update_one(
         {'_id': ObjectId(chat_id)},
@@ -789,7 +2260,7 @@ async def update_chat(chat_id: str, chat: Chat):
     
     # Update memory
     if updated_chat and 'messages' in updated_chat:
-        await memory_service.store_conversation_memory(chat_id, updated_chat['messages'])
+        memory_index_queue.schedule(chat_id)
     
     return convert_objectid_to_str(updated_chat)
 
@@ -800,6 +2271,7 @@ async def delete_chat(chat_id: str):
         raise HTTPException(status_code=404, detail="Chat not found")
     
     # Delete associated memory
+    await memory_index_queue.discard(chat_id)
     await memory_service.delete_chat_memory(chat_id)
     
     return {"message": "Chat deleted successfully"}
@@ -826,159 +2298,983 @@ async def update_chat_message_content(chat_id: str, message_index: int, content:
         return False
 
 
-async def stream_model_response(prompt: str, model_value: str, chat_history: List[dict] | None = None, chat_id: str | None = None):
+async def stream_model_response(prompt: str, model_value: str, chat_history: List[dict] | None = None, chat_id: str | None = None, protocol: int = STREAM_PROTOCOL_LEGACY, history_length: Optional[int] = None):
     accumulated_content = ""
     ai_message_index = None
+    stream_parser = IncrementalContentParser()
+    delta_encoder = SectionDeltaEncoder() if protocol == STREAM_PROTOCOL_DELTA else None
+    persistence = None
+    generation = None
+    ticket = None
+    context_task = None
+    cache_key = None
+    cached_response = None
+    producer = None
+    cancelled = False
+    final_status = "complete"
+    started = time.perf_counter()
+    first_token_at = last_token_at = None
+    tokens = 0
     
     try:
-        # Find the index of the AI message we're updating
-        if chat_id and chat_history:
-            ai_message_index = len(chat_history) + 1
-        
-        # Build context messages
-        if chat_history and chat_id:
-            context_messages = await build_context_messages(chat_history, prompt, chat_id)
+        if history_length is None:
+            history_length = len(chat_history or [])
+        
+        # Find the index of the AI message we're updating (it follows the user message)
+        if chat_id:
+            ai_message_index = history_length + 1
+            persistence = StreamPersistenceBuffer(chat_id, ai_message_index, model=model_value)
+            generation = generation_registry.register(chat_id, ai_message_index)
+        
+        # Memory retrieval for the context runs while waiting for a slot and loading the model
+        context_task = asyncio.create_task(prepare_context_messages(prompt, model_value, chat_history, chat_id, history_length))
+        
+        # A cached answer needs the final context first, and then no generation slot
+        if response_cache.enabled:
+            cache_key = await response_cache.key_for(model_value, await context_task)
+            if cache_key:
+                cached_response = await response_cache.get(cache_key)
+        
+        if cached_response is None:
+            # Wait for a generation slot, telling the client its place in the queue
+            ticket = generation_scheduler.enqueue(model_value)
+            if generation:
+                generation.queued = ticket
+            while not ticket.admitted and not (generation and generation.cancel_requested):
+                position = generation_scheduler.position(ticket)
+                if delta_encoder:
+                    payload = {"v": STREAM_PROTOCOL_DELTA, "seq": delta_encoder.next_seq(), "status": "queued", "position": position}
+                else:
+                    payload = {"status": "queued", "position": position, "model": model_value}
+                yield {
+                    "event": "queue",
+                    "data": json.dumps(payload)
+                }
+                await ticket.changed.wait()
+                ticket.changed.clear()
+            
+            # A generation cancelled while queued must not load its model
+            if generation and generation.cancel_requested:
+                await context_task
+            elif not context_task.done():
+                await asyncio.gather(context_task, preload_model(model_value))
         else:
-            context_messages = []
-            if chat_history:
-                for msg in chat_history:
-                    context_messages.append({
-                        "role": "user" if msg["type"] == "user" else "assistant",
-                        "content": msg["content"]
-                    })
-        
-        context_messages.append({"role": "user", "content": prompt})
-        
-        logger.info(f"Using {len(context_messages)} messages for context")
-        
-        stream = ollama.chat(
-            model=model_value,
-            messages=context_messages,
-            stream=True,
-            options={"temperature": TEMPERATURE}
-        )
+            logger.info(f"Replaying cached response for chat {chat_id} ({len(cached_response)} characters)")
+        context_messages = context_task.result()
+        
+        # The upstream call runs in its own task so a cancel can stop it at any time.
+        # The bounded queue keeps backpressure: slow parsing or persistence stalls the upstream read.
+        # A generation cancelled while queued has its task cancelled by attach()
+        # before it starts, so the model is never called.
+        chunks: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        if cached_response is not None:
+            producer = asyncio.create_task(replay_cached_response(cached_response, chunks))
+        else:
+            producer = asyncio.create_task(pump_model_stream(model_value, context_messages, chunks))
+        producer.add_done_callback(lambda _: end_model_stream(chunks))
+        if generation:
+            generation.attach(producer)
         
         # Stream and update database simultaneously
-        for chunk in stream:
+        while True:
+            if chunks.empty() and producer.done():
+                break
+            chunk = await chunks.get()
+            if chunk is STREAM_END:
+                break
             if chunk and hasattr(chunk, 'message') and chunk.message.content:
                 accumulated_content += chunk.message.content
+                last_token_at = time.perf_counter()
+                # Replayed cache hits are neither model tokens nor model latency
+                if cached_response is None:
+                    if first_token_at is None:
+                        first_token_at = last_token_at
+                        generation_ttft.observe(first_token_at - started, model_value)
+                    tokens += 1
+                    generated_tokens.inc(1, model_value)
                 
-                # Parse content into sections for better frontend handling
-                sections = content_parser.parse_content_to_sections(accumulated_content)
+                # Parse content into sections for better frontend handling (only the open tail is re-parsed)
+                sections = stream_parser.feed(chunk.message.content)
+                chunk_parse_time.observe(time.perf_counter() - last_token_at, model_value)
                 
-                # Update database with current accumulated content and sections
-                if chat_id and ai_message_index is not None:
-                    await update_chat_message_with_sections(
-                        chat_id, 
-                        ai_message_index, 
+                # Buffer the update; the DB is written on the time/size thresholds
+                if persistence:
+                    await persistence.update(accumulated_content, sections)
+                
+                # Kept on the generation so a client that fell behind can be resynced
+                if generation:
+                    generation.content = accumulated_content
+                    generation.sections = sections
+                
+                # Yield to frontend with sections
+                if delta_encoder:
+                    payload = delta_encoder.encode(
+                        chunk.message.content,
                         accumulated_content,
                         sections,
-                        is_streaming=True
+                        stream_parser.committed_count
                     )
-                
-                # Yield to frontend with sections
-                yield {
-                    "event": "message",
-                    "data": json.dumps({
+                else:
+                    payload = {
                         "content": chunk.message.content,
                         "accumulated_content": accumulated_content,
-                        "sections": [section.dict() for section in sections],
+                        "sections": sections_to_dicts(sections),
                         "status": "streaming",
                         "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    })
+                    }
+                yield {
+                    "event": "message",
+                    "data": json.dumps(payload)
                 }
-                await asyncio.sleep(0.01)
+        
+        # Surface upstream errors; a cancelled producer just ends the stream
+        outcome = (await asyncio.gather(producer, return_exceptions=True))[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        
+        if cache_key and cached_response is None and accumulated_content and not (generation and generation.cancel_requested):
+            await response_cache.put(cache_key, accumulated_content)
+        
+        if generation and generation.cancel_requested:
+            accumulated_content += GENERATION_CANCELLED_MARKER
+            stream_parser.feed(GENERATION_CANCELLED_MARKER)
+            logger.info(f"Generation for chat {chat_id} cancelled after {len(accumulated_content)} characters")
         
         # Mark as complete in database
-        if chat_id and ai_message_index is not None:
-            final_sections = content_parser.parse_content_to_sections(accumulated_content)
-            await update_chat_message_with_sections(
-                chat_id, 
-                ai_message_index, 
-                accumulated_content,
-                final_sections,
-                is_streaming=False
-            )
+        if persistence:
+            await persistence.close(accumulated_content, stream_parser.sections)
             
-            # Update memory
-            updated_chat = await chats_collection.find_one({'_id': ObjectId(chat_id)})
-            if updated_chat and 'messages' in updated_chat:
-                await memory_service.store_conversation_memory(chat_id, updated_chat['messages'])
-        
+            # Index the new user/AI pair in memory, in the background
+            memory_index_queue.schedule(chat_id, history_length)
+        
+    except (asyncio.CancelledError, GeneratorExit):
+        # The generation task was cancelled (e.g. on shutdown): stop the upstream
+        # generation and persist the partial response before the cancellation propagates
+        cancelled = True
+        if generation:
+            generation.cancel()
+        elif producer:
+            producer.cancel()
+        if persistence:
+            stream_parser.feed(GENERATION_CANCELLED_MARKER)
+            await persistence.close(accumulated_content + GENERATION_CANCELLED_MARKER, stream_parser.sections)
+            memory_index_queue.schedule(chat_id, history_length)
+        raise
     except Exception as e:
         logger.error(f"Error in stream_model_response: {str(e)}")
+        final_status = "error"
         
-        if chat_id and ai_message_index is not None:
+        if persistence:
             error_content = accumulated_content + f"\n\n[Error occurred: {str(e)}]"
-            error_sections = content_parser.parse_content_to_sections(error_content)
-            await update_chat_message_with_sections(
-                chat_id, 
-                ai_message_index, 
-                error_content,
-                error_sections,
-                is_streaming=False
-            )
+            error_sections = section_cache.get_or_parse(error_content)
+            await persistence.close(error_content, error_sections)
         
-        yield {
-            "event": "error",
-            "data": json.dumps({
+        if delta_encoder:
+            payload = {
+                "v": STREAM_PROTOCOL_DELTA,
+                "seq": delta_encoder.next_seq(),
+                "error": str(e),
+                "status": "error"
+            }
+        else:
+            payload = {
                 "error": str(e),
                 "status": "error",
                 "accumulated_content": accumulated_content
-            })
+            }
+        yield {
+            "event": "error",
+            "data": json.dumps(payload)
         }
     finally:
-        yield {
-            "event": "message",
-            "data": json.dumps({
-                "content": "",
-                "status": "complete",
-                "accumulated_content": accumulated_content,
-                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
+        if context_task and not context_task.done():
+            context_task.cancel()
+        if ticket:
+            generation_scheduler.release(ticket)
+        if generation:
+            generation_registry.unregister(generation)
+        if cancelled or (generation and generation.cancel_requested):
+            final_status = "cancelled"
+        if cached_response is None:
+            generation_duration.observe(time.perf_counter() - started, model_value)
+        generations_total.inc(1, model_value, final_status)
+        if tokens > 1:
+            generation_token_rate.observe((tokens - 1) / max(last_token_at - first_token_at, 1e-6), model_value)
+        if persistence:
+            stream_db_writes.observe(persistence.writes, model_value)
+        if not cancelled:
+            if delta_encoder:
+                payload = delta_encoder.snapshot(
+                    "complete",
+                    accumulated_content,
+                    stream_parser.sections,
+                    time=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                )
+            else:
+                payload = {
+                    "content": "",
+                    "status": "complete",
+                    "accumulated_content": accumulated_content,
+                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+            yield {
+                "event": "message",
+                "data": json.dumps(payload)
+            }
+
+async def prepare_context_messages(prompt: str, model_value: str, chat_history: Optional[List[dict]], chat_id: Optional[str], history_length: int) -> List[dict]:
+    """Build the messages sent to the model, ending with the new prompt"""
+    if chat_history and chat_id:
+        context_messages = await build_context_messages(chat_history, prompt, chat_id, history_length, model_value)
+    else:
+        context_messages = []
+        if chat_history:
+            for msg in chat_history:
+                context_messages.append({
+                    "role": "user" if msg["type"] == "user" else "assistant",
+                    "content": msg["content"]
+                })
+    
+    context_messages.append({"role": "user", "content": prompt})
+    
+    logger.info(f"Using {len(context_messages)} messages for context")
+    return context_messages
+
+
+async def preload_model(model_value: str):
+    """Have Ollama load the model (an empty prompt only loads it); failures show up on the real call"""
+    try:
+        # Same num_ctx as the chat call, or Ollama reloads the model for it
+        await ollama_client.generate(model=model_value, prompt='', keep_alive=OLLAMA_KEEP_ALIVE,
+                                     options={"num_ctx": context_budget_for(model_value)})
+    except Exception as e:
+        logger.warning(f"Preloading model {model_value} failed: {str(e)}")
+
+
+async def replay_cached_response(content: str, chunks: asyncio.Queue):
+    """Feed a cached answer into ``chunks`` like a model stream, at the configured pacing"""
+    for start in range(0, len(content), RESPONSE_CACHE_REPLAY_CHUNK):
+        piece = content[start:start + RESPONSE_CACHE_REPLAY_CHUNK]
+        await chunks.put(ollama.ChatResponse(message=ollama.Message(role='assistant', content=piece)))
+        if RESPONSE_CACHE_REPLAY_DELAY:
+            await asyncio.sleep(RESPONSE_CACHE_REPLAY_DELAY)
+
+
+class ResponseCache:
+    """Cache of complete answers keyed by model digest and normalized context.
+
+    With temperature 0 the same model and context give the same answer, so a
+    hit is replayed instead of generated. Entries live in a size-bounded LRU in
+    memory and in files under ``disk_dir``, itself bounded and evicted oldest first.
+    """
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE_ENABLED,
+                 memory_bytes: int = RESPONSE_CACHE_MEMORY_BYTES,
+                 disk_dir: str = RESPONSE_CACHE_DIR,
+                 disk_bytes: int = RESPONSE_CACHE_DISK_BYTES):
+        self.enabled = enabled and TEMPERATURE == 0
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_size = 0
+        self._disk: Optional["OrderedDict[str, int]"] = None  # key -> file size, oldest first
+        self._disk_size = 0
+
+    async def key_for(self, model_value: str, context_messages: List[dict]) -> Optional[str]:
+        """Cache key for a generation, or None if the model digest is unknown"""
+        try:
+            digest = await model_catalog.digest_for(model_value)
+        except Exception as e:
+            logger.warning(f"No model digest for response cache: {str(e)}")
+            return None
+        if not digest:
+            return None
+        normalized = [[message["role"], message["content"].strip()] for message in context_messages]
+        return content_hash(json.dumps([digest, TEMPERATURE, context_budget_for(model_value), normalized]))
+
+    async def get(self, key: str) -> Optional[str]:
+        content = self._memory.get(key)
+        if content is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return content
+        if self.disk_dir:
+            await self._load_disk_index()
+            if key in self._disk:
+                content = await asyncio.to_thread(self._read_file, key)
+                if content is not None:
+                    self._disk.move_to_end(key)
+                    self._remember(key, content)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return content
+                self._forget_file(key)
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, content: str):
+        self._remember(key, content)
+        self.stores += 1
+        if not self.disk_dir:
+            return
+        try:
+            await self._load_disk_index()
+            size = await asyncio.to_thread(self._write_file, key, content)
+            self._forget_file(key)
+            self._disk[key] = size
+            self._disk_size += size
+            evicted = []
+            while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+                old_key, old_size = self._disk.popitem(last=False)
+                self._disk_size -= old_size
+                evicted.append(old_key)
+            if evicted:
+                await asyncio.to_thread(self._delete_files, evicted)
+        except OSError as e:
+            logger.error(f"Error writing response cache: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_entries": len(self._disk or {}),
+            "disk_bytes": self._disk_size,
+        }
+
+    def _remember(self, key: str, content: str):
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = content
+        self._memory_size += len(content)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+
+    def _forget_file(self, key: str):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+
+    async def _load_disk_index(self):
+        if self._disk is None:
+            entries = await asyncio.to_thread(self._scan_dir)
+            self._disk = OrderedDict(entries)
+            self._disk_size = sum(size for _, size in entries)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.txt")
+
+    def _scan_dir(self) -> List[tuple]:
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.txt'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        return [(key, size) for _, key, size in sorted(entries)]
+
+    def _read_file(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), encoding='utf-8') as cached:
+                content = cached.read()
+            os.utime(self._path(key))  # Keeps the on-disk order LRU across restarts
+            return content
+        except OSError:
+            return None
+
+    def _write_file(self, key: str, content: str) -> int:
+        path = self._path(key)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as cached:
+            cached.write(content)
+        os.replace(f"{path}.tmp", path)
+        return os.path.getsize(path)
+
+    def _delete_files(self, keys: List[str]):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+response_cache = ResponseCache()
+
+
+async def pump_model_stream(model_value: str, context_messages: List[dict], chunks: asyncio.Queue):
+    """Call the model and move its streamed chunks into ``chunks`` until it ends or is cancelled"""
+    # Cancelling this task closes the upstream stream (and its HTTP response) at the pending read
+    stream = await ollama_client.chat(
+        model=model_value,
+        messages=context_messages,
+        stream=True,
+        options={"temperature": TEMPERATURE, "num_ctx": context_budget_for(model_value)},
+        keep_alive=OLLAMA_KEEP_ALIVE
+    )
+    async for chunk in stream:
+        await chunks.put(chunk)
+
+
+def end_model_stream(chunks: asyncio.Queue):
+    """Signal the consumer that the producer is done; it stops on the sentinel,
+    or on an empty queue once the producer is done if there was no room for it"""
+    try:
+        chunks.put_nowait(STREAM_END)
+    except asyncio.QueueFull:
+        pass
+
+
+class GenerationTicket:
+    """A request's place in the generation queue"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.admitted = False
+        self.released = False
+        self.bypassed = 0
+        self.changed = asyncio.Event()  # Set when admitted or when the queue position moved
+
+
+class GenerationScheduler:
+    """Admission control in front of model calls.
+
+    Requests wait in FIFO order until both the global and the per-model limit
+    allow them to run. A request for a model that is already loaded may overtake
+    the head of the queue (at most SCHEDULER_MAX_BYPASS times per request), so
+    requests are batched per model instead of Ollama swapping models back and forth.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_GENERATIONS,
+                 max_per_model: int = MAX_GENERATIONS_PER_MODEL,
+                 max_bypass: int = SCHEDULER_MAX_BYPASS):
+        self.max_concurrent = max_concurrent
+        self.max_per_model = max_per_model
+        self.max_bypass = max_bypass
+        self._waiting: List[GenerationTicket] = []
+        self._running: Dict[str, int] = {}
+        self._active = 0
+        self._last_model: Optional[str] = None
+
+    def limit_for(self, model: str) -> int:
+        return MODEL_GENERATION_LIMITS.get(model, self.max_per_model)
+
+    def enqueue(self, model: str) -> GenerationTicket:
+        ticket = GenerationTicket(model)
+        self._waiting.append(ticket)
+        self._dispatch()
+        if not ticket.admitted:
+            logger.info(f"Generation for {model} queued at position {len(self._waiting)} ({self._active} running)")
+        return ticket
+
+    def position(self, ticket: GenerationTicket) -> int:
+        """1-based queue position, 0 once admitted"""
+        return 0 if ticket.admitted else self._waiting.index(ticket) + 1
+
+    def release(self, ticket: GenerationTicket):
+        """Free the ticket's slot, or drop it from the queue if it never ran"""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted:
+            self._active -= 1
+            self._running[ticket.model] -= 1
+            if not self._running[ticket.model]:
+                del self._running[ticket.model]
+            self._last_model = ticket.model
+        else:
+            self._waiting.remove(ticket)
+            self._notify_waiting()
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._active,
+            "waiting": len(self._waiting),
+            "running_by_model": dict(self._running),
         }
 
+    def _is_loaded(self, model: str) -> bool:
+        return model in self._running or model == self._last_model
+
+    def _next_ticket(self) -> Optional[GenerationTicket]:
+        eligible = [t for t in self._waiting if self._running.get(t.model, 0) < self.limit_for(t.model)]
+        if not eligible:
+            return None
+        head = eligible[0]
+        if head.bypassed >= self.max_bypass or self._is_loaded(head.model):
+            return head
+        for ticket in eligible[1:]:
+            if self._is_loaded(ticket.model):
+                head.bypassed += 1
+                return ticket
+        return head
+
+    def _dispatch(self):
+        admitted = False
+        while self._waiting and self._active < self.max_concurrent:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            self._waiting.remove(ticket)
+            ticket.admitted = True
+            self._active += 1
+            self._running[ticket.model] = self._running.get(ticket.model, 0) + 1
+            ticket.changed.set()
+            admitted = True
+        if admitted:
+            self._notify_waiting()
+
+    def _notify_waiting(self):
+        for ticket in self._waiting:
+            ticket.changed.set()
+
+generation_scheduler = GenerationScheduler()
+
+
+class ActiveGeneration:
+    """Handle on a running generation so it can be stopped from outside its stream"""
+
+    def __init__(self, chat_id: str, message_index: int):
+        self.chat_id = chat_id
+        self.message_index = message_index
+        self.cancel_requested = False
+        self.done = asyncio.Event()
+        self.queued: Optional[GenerationTicket] = None
+        self.content = ""
+        self.sections: List[ParsedSection] = []
+        self._producer: Optional[asyncio.Task] = None
+
+    def attach(self, producer: asyncio.Task):
+        self._producer = producer
+        if self.cancel_requested:
+            producer.cancel()
+
+    def cancel(self):
+        """Request the generation to stop; the upstream read is cancelled immediately"""
+        self.cancel_requested = True
+        if self._producer and not self._producer.done():
+            self._producer.cancel()
+        elif self.queued and not self.queued.admitted:
+            self.queued.changed.set()
+
+
+class GenerationRegistry:
+    """Generations running in this process, keyed by chat_id"""
+
+    def __init__(self):
+        self._active: Dict[str, ActiveGeneration] = {}
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def register(self, chat_id: str, message_index: int) -> ActiveGeneration:
+        generation = ActiveGeneration(chat_id, message_index)
+        self._active[chat_id] = generation
+        return generation
+
+    def unregister(self, generation: ActiveGeneration):
+        if self._active.get(generation.chat_id) is generation:
+            del self._active[generation.chat_id]
+        generation.done.set()
+
+    def get(self, chat_id: str) -> Optional[ActiveGeneration]:
+        return self._active.get(chat_id)
+
+    async def cancel(self, chat_id: str, timeout: float = GENERATION_CANCEL_TIMEOUT) -> bool:
+        """Stop the chat's running generation and wait until its partial content is stored"""
+        generation = self._active.get(chat_id)
+        if generation is None:
+            return False
+        generation.cancel()
+        try:
+            await asyncio.wait_for(generation.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Generation for chat {chat_id} did not stop within {timeout}s")
+        return True
+
+generation_registry = GenerationRegistry()
+
+
+def parse_stream_event_id(event_id: str):
+    """Split an SSE event id ``{chat_id}.{message_index}.{n}``; None if it is not one of ours"""
+    parts = event_id.strip().split('.')
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return parts[0], int(parts[1]), int(parts[2])
+
+
+class GenerationStream:
+    """SSE events of one generation, replayable to clients that reconnect.
+
+    The generation runs in its own task and appends its events to a buffer;
+    every connected client follows the buffer from its last event id. Events are
+    kept up to STREAM_REPLAY_BYTES; legacy events, which are large but whose
+    ``content`` deltas clients append, are dropped sooner, once every connected
+    client has them. A client that falls behind the buffer gets one event with
+    everything it missed (see ``_catch_up_event``). A generation left without
+    clients keeps running for STREAM_RESUME_GRACE seconds, then it is cancelled
+    like an explicit cancel.
+    """
+
+    def __init__(self, chat_id: str, message_index: int, protocol: int):
+        self.chat_id = chat_id
+        self.message_index = message_index
+        self.protocol = protocol
+        self.id = f"{chat_id}.{message_index}"
+        self.finished = False
+        self.subscribers = 0
+        self._events: deque = deque()
+        self.buffered_bytes = 0
+        self._seq = 0
+        self._followers: Dict[int, int] = {}  # follow() call -> last event it yielded
+        self._text_lengths: List[int] = []  # Legacy: generated text length at each event
+        self._appended = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._grace: Optional[asyncio.TimerHandle] = None
+
+    def start(self, events):
+        self._task = asyncio.create_task(self._run(events))
+
+    async def _run(self, events):
+        try:
+            async for event in events:
+                self._append(event)
+        except Exception as e:
+            logger.error(f"Generation stream {self.id} failed: {str(e)}")
+        finally:
+            self.finished = True
+            self._trim()
+            self._cancel_grace()
+            self._wake()
+            generation_streams.finished(self)
+
+    def _append(self, event: dict):
+        self._seq += 1
+        event["id"] = f"{self.id}.{self._seq}"
+        self._events.append((self._seq, event))
+        self.buffered_bytes += len(event["data"])
+        if self.protocol != STREAM_PROTOCOL_DELTA:
+            generation = generation_registry.get(self.chat_id)
+            if generation and generation.message_index == self.message_index:
+                self._text_lengths.append(len(generation.content))
+            else:
+                self._text_lengths.append(self._text_lengths[-1] if self._text_lengths else 0)
+        self._trim()
+        self._wake()
+
+    def _trim(self):
+        """Drop the oldest events no longer needed, always keeping the latest one.
+
+        A finished protocol 2 stream ends with a complete snapshot, so that is all
+        it keeps. Legacy events are dropped once every connected client has them.
+        """
+        budget = 0 if self.finished and self.protocol == STREAM_PROTOCOL_DELTA else STREAM_REPLAY_BYTES
+        consumed = 0
+        if self.protocol != STREAM_PROTOCOL_DELTA:
+            consumed = min(self._followers.values(), default=self._seq)
+        while len(self._events) > 1 and (self.buffered_bytes > budget or self._events[0][0] <= consumed):
+            self.buffered_bytes -= len(self._events.popleft()[1]["data"])
+
+    def _wake(self):
+        self._appended.set()
+        self._appended = asyncio.Event()
+
+    def _resync_event(self) -> Optional[dict]:
+        """Snapshot of the current state for a protocol 2 client that missed events.
+
+        Every protocol 2 event carries the next ``seq``, so the snapshot takes the
+        number of the last buffered event. A finished stream ends with a complete
+        snapshot already, so None is returned and only that event is replayed.
+        """
+        generation = generation_registry.get(self.chat_id)
+        if self.finished or generation is None or generation.message_index != self.message_index:
+            return None
+        payload = {
+            "v": STREAM_PROTOCOL_DELTA,
+            "seq": self._seq,
+            "status": "streaming",
+            "snapshot": {
+                "accumulated_content": generation.content,
+                "sections": sections_to_dicts(generation.sections)
+            }
+        }
+        return {"event": "message", "id": f"{self.id}.{self._seq}", "data": json.dumps(payload)}
+
+    def _catch_up_event(self, last_seen: int) -> Optional[tuple]:
+        """(seq, event): one legacy event whose ``content`` is all the text generated after ``last_seen``.
+
+        It takes the place of the latest buffered event, or of the one before it
+        when the latest is not a streaming event (that one is then replayed as is).
+        None when no text was missed.
+        """
+        seq, latest = self._events[-1]
+        payload = json.loads(latest["data"])
+        accumulated = payload.get("accumulated_content")
+        known = self._text_lengths[last_seen - 1] if last_seen else 0
+        if accumulated is None or len(accumulated) <= known:
+            return None
+        if payload.get("status") != "streaming":
+            seq -= 1
+            payload = {"status": "streaming", "time": payload.get("time")}
+        payload["content"] = accumulated[known:]
+        payload["accumulated_content"] = accumulated
+        return seq, {"event": "message", "id": f"{self.id}.{seq}", "data": json.dumps(payload)}
+
+    async def follow(self, last_seen: int = 0):
+        """Events after ``last_seen``, then live ones until the generation ends"""
+        self.subscribers += 1
+        self._cancel_grace()
+        follower = object()
+        self._followers[id(follower)] = last_seen
+        try:
+            while True:
+                appended = self._appended
+                if self._seq > last_seen:
+                    first = self._events[0][0]
+                    if last_seen + 1 < first:
+                        # Fell behind the replay buffer
+                        logger.info(f"Client of generation {self.id} missed events {last_seen + 1}-{first - 1}")
+                        if self.protocol == STREAM_PROTOCOL_DELTA:
+                            resync = self._resync_event()
+                            last_seen = self._seq if resync else self._seq - 1
+                        else:
+                            catch_up = self._catch_up_event(last_seen)
+                            last_seen = catch_up[0] if catch_up else first - 1
+                            resync = catch_up and catch_up[1]
+                        self._followers[id(follower)] = last_seen
+                        if resync:
+                            yield resync
+                            continue
+                    pending = []
+                    for seq, event in reversed(self._events):
+                        if seq <= last_seen:
+                            break
+                        pending.append((seq, event))
+                    for seq, event in reversed(pending):
+                        yield event
+                        last_seen = self._followers[id(follower)] = seq
+                    self._trim()
+                    continue
+                if self.finished:
+                    return
+                await appended.wait()
+        finally:
+            self.subscribers -= 1
+            del self._followers[id(follower)]
+            self._trim()
+            if self.subscribers == 0 and not self.finished:
+                self._grace = asyncio.get_running_loop().call_later(STREAM_RESUME_GRACE, self._abandon)
+
+    def _cancel_grace(self):
+        if self._grace:
+            self._grace.cancel()
+            self._grace = None
+
+    def _abandon(self):
+        self._grace = None
+        generation = generation_registry.get(self.chat_id)
+        if generation and generation.message_index == self.message_index:
+            logger.info(f"No client reconnected to generation {self.id} within {STREAM_RESUME_GRACE}s, cancelling it")
+            generation.cancel()
+
+
+class GenerationStreamRegistry:
+    """Running and recently finished generation streams, keyed by stream id"""
+
+    def __init__(self):
+        self._streams: Dict[str, GenerationStream] = {}
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def start(self, stream: GenerationStream, events):
+        self._streams[stream.id] = stream
+        stream.start(events)
+
+    def get(self, stream_id: str) -> Optional[GenerationStream]:
+        return self._streams.get(stream_id)
+
+    def finished(self, stream: GenerationStream):
+        asyncio.get_running_loop().call_later(STREAM_RETENTION, self._expire, stream)
+
+    def _expire(self, stream: GenerationStream):
+        if self._streams.get(stream.id) is stream:
+            del self._streams[stream.id]
+
+    def stats(self) -> dict:
+        running = sum(1 for stream in self._streams.values() if not stream.finished)
+        return {
+            "running": running,
+            "finished": len(self._streams) - running,
+            "clients": sum(stream.subscribers for stream in self._streams.values()),
+            "buffered_bytes": sum(stream.buffered_bytes for stream in self._streams.values())
+        }
+
+generation_streams = GenerationStreamRegistry()
+
 # * Update the database update function to handle sections
-async def update_chat_message_with_sections(chat_id: str, message_index: int, content: str, sections: List[ContentSection], is_streaming: bool = True):
+async def update_chat_message_with_sections(chat_id: str, message_index: int, content: str, sections: List[ParsedSection], is_streaming: bool = True):
     """Update message content with parsed sections in the database"""
     try:
+        update = {
+            f"messages.{message_index}.content": content,
+            f"messages.{message_index}.isStreaming": is_streaming,
+            "updated_at": datetime.now().isoformat()
+        }
+        if STORE_SECTIONS:
+            update[f"messages.{message_index}.sections"] = sections_to_dicts(sections)
         result = await chats_collection.update_one(
             {"_id": ObjectId(chat_id)},
-            {
-                "$set": {
-                    f"messages.{message_index}.content": content,
-                    f"messages.{message_index}.sections": [section.dict() for section in sections],
-                    f"messages.{message_index}.isStreaming": is_streaming,
-                    "updated_at": datetime.now().isoformat()
-                }
-            }
+            {"$set": update}
         )
         return result.modified_count > 0
     except Exception as e:
         logger.error(f"Error updating message with sections: {str(e)}")
         return False
 
+class StreamPersistenceBuffer:
+    """Write-behind buffer that coalesces per-chunk message updates into few DB writes.
+
+    The latest content/sections are kept in memory and written when either
+    ``flush_interval`` seconds have passed or ``flush_bytes`` characters are
+    pending since the last write. ``close`` always writes the final state.
+    """
+
+    def __init__(self, chat_id: str, message_index: int,
+                 flush_interval: float = STREAM_FLUSH_INTERVAL,
+                 flush_bytes: int = STREAM_FLUSH_BYTES,
+                 model: str = ""):
+        self.chat_id = chat_id
+        self.message_index = message_index
+        self.model = model
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+
+        self.updates = 0  # Updates received, i.e. writes the unbuffered path would have made
+        self.writes = 0   # DB writes actually performed
+        self._content = ""
+        self._sections: List[ParsedSection] = []
+        self._persisted_length = 0
+        self._last_flush = time.monotonic()
+        self._dirty = False
+        self._closed = False
+
+    @property
+    def saved_writes(self) -> int:
+        return self.updates - self.writes
+
+    async def update(self, content: str, sections: List[ParsedSection]):
+        """Record the latest streaming state and write it if a threshold is reached"""
+        self.updates += 1
+        self._content = content
+        self._sections = sections
+        self._dirty = True
+
+        pending = len(content) - self._persisted_length
+        if pending >= self.flush_bytes or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush(is_streaming=True)
+
+    async def flush(self, is_streaming: bool = True):
+        if not self._dirty:
+            return
+        started = time.perf_counter()
+        await update_chat_message_with_sections(
+            self.chat_id,
+            self.message_index,
+            self._content,
+            self._sections,
+            is_streaming=is_streaming
+        )
+        stream_db_write_time.observe(time.perf_counter() - started, self.model)
+        self.writes += 1
+        self._persisted_length = len(self._content)
+        self._last_flush = time.monotonic()
+        self._dirty = False
+
+    async def close(self, content: str, sections: List[ParsedSection]):
+        """Write the final state (completion, error or cancel) exactly once"""
+        if self._closed:
+            return
+        self._closed = True
+        # Reads of the finished message reuse these sections instead of parsing it again
+        section_cache.put(content, sections)
+        self.updates += 1
+        self._content = content
+        self._sections = sections
+        self._dirty = True
+        await self.flush(is_streaming=False)
+        logger.info(
+            f"Persisted chat {self.chat_id} message {self.message_index} with "
+            f"{self.writes} DB writes for {self.updates} updates (saved {self.saved_writes})"
+        )
+
+async def ensure_message_count(chat_id: str) -> bool:
+    """Backfill ``message_count`` on chats created before the field existed.
+
+    Returns True if the chat had to be backfilled.
+    """
+    result = await chats_collection.update_one(
+        {'_id': ObjectId(chat_id), 'message_count': {'$exists': False}},
+        [{'$set': {'message_count': {'$size': {'$ifNull': ['$messages', []]}}}}]
+    )
+    return result.modified_count > 0
+
+async def append_chat_messages(chat_id: str, new_messages: List[dict], history_window: int) -> Optional[dict]:
+    """Atomically $push messages to a chat.
+
+    Returns the updated chat with ``model``, ``message_count`` and only the last
+    ``history_window`` messages before the pushed ones (plus the pushed ones),
+    or None if the chat does not exist or has no model. The chat must already
+    have ``message_count`` (see ensure_message_count).
+    """
+    return await chats_collection.find_one_and_update(
+        {'_id': ObjectId(chat_id), 'model.name': {'$exists': True}},
+        {
+            '$push': {'messages': {'$each': new_messages}},
+            '$inc': {'message_count': len(new_messages)},
+            '$set': {'updated_at': datetime.now().isoformat()}
+        },
+        projection={
+            'model': 1,
+            'message_count': 1,
+            'messages': {'$slice': -(history_window + len(new_messages))}
+        },
+        return_document=ReturnDocument.AFTER
+    )
+
 # * Update the stream endpoint to prepare the chat with user and AI messages before streaming
 @app.get("/stream-generate")
-async def stream_completion(prompt: str, chat_id: Optional[str] = None):
+async def stream_completion(prompt: str, chat_id: Optional[str] = None, protocol: int = STREAM_PROTOCOL_LEGACY, last_event_id: Optional[str] = Header(None)):
+    """Stream a generation over SSE.
+
+    ``protocol=1`` (default) keeps the original event format with the full content
+    and sections on every event; ``protocol=2`` sends delta events (see SectionDeltaEncoder).
+    A request with a ``Last-Event-ID`` header from an earlier stream of the chat
+    gets the events it missed instead of a new generation (see GenerationStream).
+    """
     if not prompt:
         raise HTTPException(status_code=400, detail="Prompt is required")
+    if protocol not in (STREAM_PROTOCOL_LEGACY, STREAM_PROTOCOL_DELTA):
+        raise HTTPException(status_code=400, detail=f"Unsupported stream protocol: {protocol}")
+    
+    # A reconnecting EventSource resumes the generation it was following instead of starting another
+    if chat_id and last_event_id:
+        resumed = await resume_generation_stream(chat_id, last_event_id, protocol)
+        if resumed is not None:
+            return EventSourceResponse(resumed, media_type="text/event-stream")
     
     chat_history = []
     model_value = None
     
     if chat_id:
-        chat = await chats_collection.find_one({'_id': ObjectId(chat_id)})
-        if chat and 'messages' in chat:
-            chat_history = chat['messages']
-            if 'model' in chat and 'name' in chat['model']:
-                model_value = chat['model']['name']
-            else:
-                raise HTTPException(status_code=400, detail="Model information is missing from the chat")
-        else:
-            raise HTTPException(status_code=404, detail="Chat not found or has no messages")
-        
-        # Add user message and empty AI message to the database before streaming
         user_message = {
             "type": "user",
             "content": prompt,
@@ -992,66 +3288,140 @@ async def stream_completion(prompt: str, chat_id: Optional[str] = None):
             "isStreaming": True
         }
         
-        # Update chat with new messages
-        updated_messages = chat_history + [user_message, ai_message]
-        await chats_collection.update_one(
-            {'_id': ObjectId(chat_id)},
-            {
-                '$set': {
-                    'messages': updated_messages,
-                    'updated_at': datetime.now().isoformat()
-                }
-            }
-        )
+        # Chats from before message_count existed were never indexed incrementally; index them once
+        if await ensure_message_count(chat_id):
+            memory_index_queue.schedule(chat_id)
         
-        # Update chat_history for context
-        chat_history = chat_history  # Don't include the new messages in context yet
+        # Atomically append user message and empty AI message before streaming; the
+        # returned document carries the recent history needed for the context
+        chat = await append_chat_messages(chat_id, [user_message, ai_message], MAX_CONTEXT_MESSAGES)
+        if not chat:
+            exists = await chats_collection.count_documents({'_id': ObjectId(chat_id)}, limit=1)
+            if exists:
+                raise HTTPException(status_code=400, detail="Model information is missing from the chat")
+            raise HTTPException(status_code=404, detail="Chat not found or has no messages")
+        
+        model_value = chat['model']['name']
+        model_catalog.observe_model(model_value)
+        history_length = chat['message_count'] - 2
+        chat_history = chat['messages'][:-2]  # Don't include the new messages in context yet
         
     else:
         raise HTTPException(status_code=400, detail="For new chats, please use the POST /chats endpoint first")
     
-    return EventSourceResponse(
-        stream_model_response(prompt, model_value, chat_history, chat_id),
-        media_type="text/event-stream"
+    # The generation runs independently of this connection, so a client can reconnect to it
+    stream = GenerationStream(chat_id, history_length + 1, protocol)
+    generation_streams.start(stream, stream_model_response(prompt, model_value, chat_history, chat_id, protocol, history_length))
+    
+    return EventSourceResponse(stream.follow(), media_type="text/event-stream")
+
+
+async def resume_generation_stream(chat_id: str, last_event_id: str, protocol: int):
+    """Events for a client reconnecting with ``last_event_id``, or None to start a new generation.
+
+    A generation still in memory is followed from the client's last event. Once it
+    is gone the stored message is sent as the final event, so a late reconnect never
+    asks the model again.
+    """
+    parsed = parse_stream_event_id(last_event_id)
+    if parsed is None or parsed[0] != chat_id:
+        return None
+    _, message_index, last_seen = parsed
+    
+    stream = generation_streams.get(f"{chat_id}.{message_index}")
+    if stream:
+        logger.info(f"Client resumed generation {stream.id} after event {last_seen}")
+        return stream.follow(last_seen)
+    
+    chat = await chats_collection.find_one(
+        {'_id': ObjectId(chat_id)},
+        {'messages': {'$slice': [message_index, 1]}}
     )
+    messages = chat.get('messages', []) if chat else []
+    if not messages or messages[0].get('type') != 'ai':
+        return None
+    logger.info(f"Generation {chat_id}.{message_index} already finished, sending the stored message")
+    return stored_generation_events(chat_id, message_index, messages[0]['content'], protocol, last_seen + 1)
+
+
+async def stored_generation_events(chat_id: str, message_index: int, content: str, protocol: int, seq: int):
+    """Single complete event for a generation that is no longer in memory"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if protocol == STREAM_PROTOCOL_DELTA:
+        payload = {
+            "v": STREAM_PROTOCOL_DELTA,
+            "seq": seq,
+            "status": "complete",
+            "snapshot": {
+                "accumulated_content": content,
+                "sections": sections_to_dicts(section_cache.get_or_parse(content))
+            },
+            "time": now
+        }
+    else:
+        payload = {
+            "content": "",
+            "status": "complete",
+            "accumulated_content": content,
+            "time": now
+        }
+    yield {
+        "event": "message",
+        "id": f"{chat_id}.{message_index}.{seq}",
+        "data": json.dumps(payload)
+    }
 
 # * Add new endpoint to handle cancellation
 @app.post("/stream-generate/{chat_id}/cancel")
 async def cancel_stream_generation(chat_id: str):
-    """Handle stream cancellation and store partial response"""
+    """Stop the running generation for a chat and store the partial response"""
     try:
-        # Get the current chat
-        chat = await chats_collection.find_one({'_id': ObjectId(chat_id)})
+        # The generation runs in this process: stop it, it stores its partial content itself
+        if await generation_registry.cancel(chat_id):
+            return {"message": "Generation cancelled and stored"}
+        
+        # Otherwise only mark a message left streaming (e.g. by a restart) as cancelled.
+        # Only the tail of the chat is needed to find it.
+        await ensure_message_count(chat_id)
+        chat = await chats_collection.find_one(
+            {'_id': ObjectId(chat_id)},
+            {'message_count': 1, 'messages': {'$slice': -MAX_CONTEXT_MESSAGES}}
+        )
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         
         messages = chat.get('messages', [])
-        if messages:
-            # Find the last AI message and mark it as cancelled
-            for i in range(len(messages) - 1, -1, -1):
-                if messages[i]['type'] == 'ai':
-                    messages[i]['content'] += '\n\n[Generation cancelled]'
-                    messages[i]['isStreaming'] = False
+        window_start = chat['message_count'] - len(messages)
+        
+        # Find the last AI message and mark it as cancelled with a positional update
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i]['type'] == 'ai':
+                if not messages[i].get('isStreaming'):
                     break
-            
-            # Update the chat in database
-            await chats_collection.update_one(
-                {'_id': ObjectId(chat_id)},
-                {
-                    '$set': {
-                        'messages': messages,
-                        'updated_at': datetime.now().isoformat()
+                message_index = window_start + i
+                messages[i]['content'] += GENERATION_CANCELLED_MARKER
+                messages[i]['isStreaming'] = False
+                
+                await chats_collection.update_one(
+                    {'_id': ObjectId(chat_id), f'messages.{message_index}.type': 'ai'},
+                    {
+                        '$set': {
+                            f'messages.{message_index}.content': messages[i]['content'],
+                            f'messages.{message_index}.isStreaming': False,
+                            'updated_at': datetime.now().isoformat()
+                        }
                     }
-                }
-            )
-            
-            # Update memory
-            await memory_service.store_conversation_memory(chat_id, messages)
-            
-            return {"message": "Generation cancelled and stored"}
+                )
+                
+                # Update memory
+                memory_index_queue.schedule(chat_id, message_index)
+                
+                return {"message": "Generation cancelled and stored"}
         
         return {"message": "No active generation found"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error cancelling generation: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1078,20 +3448,133 @@ async def update_chat_memory(chat_id: str):
 async def get_memory_stats(chat_id: str):
     """Get memory statistics for a chat"""
     try:
-        count = await memories_collection.count_documents({"chat_id": chat_id})
+        count = await memory_service.count_memories(chat_id)
         return {
             "chat_id": chat_id,
             "stored_memories": count,
-            "memory_type": "keyword_based"
+            "memory_type": memory_service.memory_type
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Indexes required by the hot queries: (collection, keys, options)
+DATABASE_INDEXES = [
+    (memories_collection, [("chat_id", 1), ("message_index", 1)], {"name": "chat_id_message_index", "unique": True}),
+    (chats_collection, [("updated_at", -1), ("_id", -1)], {"name": "updated_at_id_desc"}),
+]
+
+# Indexes created by earlier versions that no queries use anymore
+OBSOLETE_INDEXES = [
+    (memories_collection, "chat_id_keywords"),
+]
+
+# MongoDB error codes for an existing index with the same name but other options or keys
+INDEX_CONFLICT_CODES = (85, 86)
+
+def hot_query_cursors() -> Dict[str, Any]:
+    """Cursors for the queries that run on every request, used for plan verification"""
+    return {
+        "memories by chat": memories_collection.find({"chat_id": ""}),
+        "memory by message index": memories_collection.find({"chat_id": "", "message_index": 0}),
+        "chats by updated_at": chats_collection.find().sort('updated_at', -1),
+        "chat page by updated_at": chats_collection.find({"updated_at": {"$lt": ""}}).sort([('updated_at', -1), ('_id', -1)]),
+    }
+
+def _plan_stages(plan: Any) -> List[str]:
+    """Collect every stage name in a (possibly nested) query plan"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+async def verify_query_plans() -> Dict[str, List[str]]:
+    """Run explain() on the hot queries and warn when one falls back to a collection scan"""
+    plans = {}
+    for name, cursor in hot_query_cursors().items():
+        explanation = await cursor.explain()
+        winning_plan = explanation.get('queryPlanner', {}).get('winningPlan', {})
+        stages = _plan_stages(winning_plan)
+        plans[name] = stages
+        if 'COLLSCAN' in stages:
+            logger.warning(f"Query plan for '{name}' uses COLLSCAN: {stages}")
+        else:
+            logger.info(f"Query plan for '{name}': {stages}")
+    return plans
+
+@app.on_event("startup")
+async def ensure_database_indexes():
+    """Create the indexes the hot queries rely on and verify they are used"""
+    try:
+        for collection, keys, options in DATABASE_INDEXES:
+            try:
+                await collection.create_index(keys, **options)
+            except OperationFailure as e:
+                if e.code not in INDEX_CONFLICT_CODES:
+                    raise
+                # Same name, other options (e.g. not unique yet): rebuild it
+                logger.info(f"Rebuilding index {options['name']} on {collection.name}")
+                await collection.drop_index(options['name'])
+                await collection.create_index(keys, **options)
+        for collection, name in OBSOLETE_INDEXES:
+            if name in await collection.index_information():
+                await collection.drop_index(name)
+                logger.info(f"Dropped unused index {name} on {collection.name}")
+        logger.info(f"Ensured {len(DATABASE_INDEXES)} database indexes")
+        await verify_query_plans()
+    except Exception as e:
+        logger.error(f"Error ensuring database indexes: {str(e)}")
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    app.state.event_loop_monitor = asyncio.create_task(monitor_event_loop_lag())
+
+@app.on_event("shutdown")
+async def close_ollama_client():
+    monitor = getattr(app.state, "event_loop_monitor", None)
+    if monitor:
+        monitor.cancel()
+    await memory_index_queue.close()
+    await ollama_client.close()
+
+metrics.add(Gauge("synaptic_active_streams", "Generation streams still running",
+                  lambda: {(): generation_streams.stats()["running"]}))
+metrics.add(Gauge("synaptic_stream_clients", "Clients connected to generation streams",
+                  lambda: {(): generation_streams.stats()["clients"]}))
+metrics.add(Gauge("synaptic_running_generations", "Model calls holding a generation slot",
+                  lambda: {(model,): count for model, count in generation_scheduler.stats()["running_by_model"].items()},
+                  ("model",)))
+metrics.add(Gauge("synaptic_queued_generations", "Generations waiting for a slot",
+                  lambda: {(): generation_scheduler.stats()["waiting"]}))
+metrics.add(Gauge("synaptic_context_packing", "Running totals of context packing decisions",
+                  lambda: {(stat,): value for stat, value in context_packing_stats.items()}, ("stat",)))
+metrics.add(Gauge("synaptic_memory_index_queue_length", "Chats waiting to be indexed in memory",
+                  lambda: {(): len(memory_index_queue)}))
+metrics.add(Gauge("synaptic_memory_index_jobs", "Memory index jobs run, and schedule requests merged into a waiting job",
+                  lambda: {("run",): memory_index_queue.jobs, ("merged",): memory_index_queue.merged}, ("result",)))
+
+@app.get("/metrics")
+async def get_metrics():
+    """Process metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/health")
 async def health_check():
     return {
         "status": "healthy",
-        "memory_system": "keyword_based",
+        "memory_system": memory_service.memory_type,
+        "context_layout": CONTEXT_LAYOUT,
+        "context_packing": context_packing_stats,
+        "generation_queue": generation_scheduler.stats(),
+        "section_cache": section_cache.stats(),
+        "memory_index_queue": len(memory_index_queue),
+        "response_cache": response_cache.stats(),
+        "generation_streams": generation_streams.stats(),
         "database": "mongodb"
     }
 
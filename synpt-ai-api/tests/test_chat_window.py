@@ -0,0 +1,54 @@
+"""fetch_chat_window must return the right slice and paging indices for any ``before``."""
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+
+
+@pytest.fixture
+def chat_id(monkeypatch):
+    collection = AsyncMongoMockClient().synaptic_test.chats
+    monkeypatch.setattr(main, "chats_collection", collection)
+    messages = [{"role": "user", "content": f"m{i}", "sections": []} for i in range(10)]
+    result = asyncio.run(collection.insert_one({"title": "t", "messages": messages}))
+    return str(result.inserted_id)
+
+
+def window(chat_id, limit, before):
+    chat = asyncio.run(main.fetch_chat_window(chat_id, limit, before, include_sections=False))
+    return [m["content"] for m in chat["messages"]], chat["window_start"], chat["next_before"]
+
+
+def test_latest_window(chat_id):
+    assert window(chat_id, 3, None) == (["m7", "m8", "m9"], 7, 7)
+
+
+def test_window_before_index(chat_id):
+    assert window(chat_id, 3, 5) == (["m2", "m3", "m4"], 2, 2)
+    assert window(chat_id, 3, 2) == (["m0", "m1"], 0, None)
+
+
+def test_before_past_the_end_is_clamped(chat_id):
+    assert window(chat_id, 3, 100) == (["m7", "m8", "m9"], 7, 7)
+
+
+def test_before_zero_is_empty(chat_id):
+    assert window(chat_id, 3, 0) == ([], 0, None)
+
+
+def test_raw_ai_messages_get_rendered_sections(monkeypatch):
+    collection = AsyncMongoMockClient().synaptic_test.chats
+    monkeypatch.setattr(main, "chats_collection", collection)
+    monkeypatch.setattr(main, "section_cache", main.SectionCache())
+    content = "Intro with **bold**\n\n```python\nx = 1\n```"
+    messages = [{"type": "user", "content": "q"}, {"type": "ai", "content": content}]
+    chat_id = str(asyncio.run(collection.insert_one({"title": "t", "messages": messages})).inserted_id)
+
+    for _ in range(2):  # A cache miss, then a hit
+        chat = asyncio.run(main.get_chat(chat_id, limit=None, before=None, include_sections=True))
+        expected = main.sections_to_dicts(main.content_parser.parse_content_to_sections(content))
+        assert chat["messages"][1]["sections"] == expected
+        assert "sections" not in chat["messages"][0]
+    assert main.section_cache.stats()["hits"] == 1
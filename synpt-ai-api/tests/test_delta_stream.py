@@ -0,0 +1,43 @@
+"""Protocol 2 streams must start with a snapshot, also when the request was queued first."""
+import asyncio
+import json
+import types
+
+import main
+
+
+class FakeOllama:
+    async def chat(self, model, messages, stream, options=None, **kwargs):
+        async def chunks():
+            for piece in ["Hello ", "**world**", "\n\n", "- item"]:
+                yield types.SimpleNamespace(message=types.SimpleNamespace(content=piece))
+        return chunks()
+
+
+async def no_preload(model: str):
+    return None
+
+
+def test_queued_stream_starts_with_snapshot(monkeypatch):
+    scheduler = main.GenerationScheduler(max_concurrent=1)
+    monkeypatch.setattr(main, "generation_scheduler", scheduler)
+    monkeypatch.setattr(main, "ollama_client", FakeOllama())
+    monkeypatch.setattr(main, "preload_model", no_preload)
+
+    async def run():
+        blocker = scheduler.enqueue("bench")
+        events = main.stream_model_response("hi", "bench", protocol=main.STREAM_PROTOCOL_DELTA)
+        payloads = [json.loads((await events.__anext__())["data"])]
+        scheduler.release(blocker)
+        payloads += [json.loads(event["data"]) async for event in events]
+        return payloads
+
+    payloads = asyncio.run(run())
+
+    assert payloads[0]["status"] == "queued"
+    streaming = [p for p in payloads if p["status"] == "streaming"]
+    assert "snapshot" in streaming[0]
+    assert all("ops" in p for p in streaming[1:])
+    assert [p["seq"] for p in payloads] == list(range(1, len(payloads) + 1))
+    assert payloads[-1]["status"] == "complete"
+    assert payloads[-1]["snapshot"]["accumulated_content"] == "Hello **world**\n\n- item"
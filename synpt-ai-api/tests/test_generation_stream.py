@@ -0,0 +1,90 @@
+"""Legacy clients build the answer from ``content`` deltas, so none may be lost."""
+import asyncio
+import json
+import types
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+
+PIECES = [f"token{i} " for i in range(200)]
+
+
+class FakeOllama:
+    async def chat(self, model, messages, stream, options=None, **kwargs):
+        async def chunks():
+            for piece in PIECES:
+                await asyncio.sleep(0)
+                yield types.SimpleNamespace(message=types.SimpleNamespace(content=piece))
+        return chunks()
+
+
+async def no_preload(model: str):
+    return None
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setattr(main, "ollama_client", FakeOllama())
+    monkeypatch.setattr(main, "preload_model", no_preload)
+    monkeypatch.setattr(main, "generation_scheduler", main.GenerationScheduler())
+    monkeypatch.setattr(main, "generation_streams", main.GenerationStreamRegistry())
+    monkeypatch.setattr(main, "STREAM_RESUME_GRACE", 5)
+    database = AsyncMongoMockClient().synaptic_test
+    monkeypatch.setattr(main, "chats_collection", database.chats)
+    monkeypatch.setattr(main, "memories_collection", database.chat_memories)
+
+
+async def new_chat() -> str:
+    chat = await main.chats_collection.insert_one(
+        {"title": "t", "messages": [], "message_count": 0, "model": {"name": "bench", "size": 0}})
+    return str(chat.inserted_id)
+
+
+async def generate(chat_id: str, last_event_id=None):
+    response = await main.stream_completion("hi", chat_id, main.STREAM_PROTOCOL_LEGACY, last_event_id)
+    return response.body_iterator
+
+
+def appended_text(events):
+    """What the web client shows: the concatenated ``content`` of every event"""
+    return "".join(json.loads(event["data"]).get("content") or "" for event in events)
+
+
+@pytest.mark.parametrize("replay_bytes", [256 * 1024, 2000])
+def test_slow_follower_gets_every_delta(monkeypatch, replay_bytes):
+    monkeypatch.setattr(main, "STREAM_REPLAY_BYTES", replay_bytes)
+
+    async def run():
+        chat_id = await new_chat()
+        fast = await generate(chat_id)
+        # A second client following the same generation from its first event
+        slow = await generate(chat_id, f"{chat_id}.1.0")
+
+        async def collect(events, delay):
+            collected = []
+            async for event in events:
+                collected.append(event)
+                await asyncio.sleep(delay)
+            return collected
+
+        return await asyncio.gather(collect(fast, 0), collect(slow, 0.002))
+
+    fast, slow = asyncio.run(run())
+    assert appended_text(fast) == appended_text(slow) == "".join(PIECES)
+    assert json.loads(slow[-1]["data"])["status"] == "complete"
+
+
+def test_reconnect_after_falling_behind_catches_up():
+    async def run():
+        chat_id = await new_chat()
+        first = await generate(chat_id)
+        events = [await first.__anext__() for _ in range(10)]
+        await first.aclose()
+        await asyncio.sleep(0.05)
+        resumed = await generate(chat_id, events[-1]["id"])
+        return events + [event async for event in resumed]
+
+    events = asyncio.run(run())
+    assert appended_text(events) == "".join(PIECES)
@@ -0,0 +1,56 @@
+"""IncrementalContentParser must produce exactly what parse_content_to_sections does."""
+import random
+
+import pytest
+
+from main import IncrementalContentParser, content_parser
+
+PARAGRAPH = "This paragraph explains **one idea** in plain words and keeps going for a while. "
+
+MIXED = "".join(
+    f"## Step {i}\n{PARAGRAPH}\n\n```python\nx = {i}\n```\n| a | b |\n|---|---|\n| {i} | **2** |\n"
+    f"<think>\nhmm\n</think>\n- point\n- other\n\n"
+    for i in range(5)
+)
+PROSE = "".join(
+    f"## Part {i}\n{PARAGRAPH * 2}\n\n1. first point\n2. second point\n\n- bullet\n\n\n  Closing {i}.\n\n"
+    for i in range(20)
+)
+
+FUZZ_PIECES = [
+    "text ", "**bold** ", "\n", "\n\n", "\n\n\n", "- item", "1. step", "# h", "## Title", "  ",
+    "- ", "1.", "*", "**", "<li>", "x</li>", "```py\n", "```", "| a | b |", "<think>\n", "\n</think>",
+]
+
+
+def stream(text: str, chunk_sizes):
+    parser = IncrementalContentParser()
+    position = 0
+    for size in chunk_sizes:
+        parser.feed(text[position:position + size])
+        position += size
+        expected = content_parser.parse_content_to_sections(parser.content)
+        assert [s.to_dict() for s in parser.sections] == [s.to_dict() for s in expected]
+        if position >= len(text):
+            break
+    return parser
+
+
+@pytest.mark.parametrize("text", [MIXED, PROSE], ids=["mixed", "prose-only"])
+@pytest.mark.parametrize("chunk", [1, 3, 16])
+def test_matches_full_parse(text, chunk):
+    parser = stream(text, [chunk] * len(text))
+    assert parser.content == text
+
+
+def test_prose_only_answer_renders_settled_paragraphs_once():
+    parser = stream(PROSE, [4] * len(PROSE))
+    # Almost all of the answer is settled prose; only the last paragraph is still open
+    assert parser._prose_end > len(PROSE) - 100
+
+
+def test_random_streams_match_full_parse():
+    rnd = random.Random(1)
+    for _ in range(2000):
+        text = "".join(rnd.choice(FUZZ_PIECES) for _ in range(rnd.randint(1, 40)))
+        stream(text, [rnd.randint(1, 6) for _ in range(len(text))])